@@ -0,0 +1,492 @@
+"""
+
+Benchmarks scroop's stages offline, so changes can be compared run to run without live job sites or OpenAI. Search
+feeds and job pages are served from a local HTTPS server, OpenAI requests go to a local mock with a set latency, and
+the same pipeline scroop.py runs (the same stages, batching, and concurrency controller) is run at every thread count
+in the grid against a fresh cache. The timings are written to a JSON file.
+
+    python benchmark.py --threads 1 2 4 8 16 --jobs 200 --llm-latency 0.5
+    python benchmark.py --compare benchmark_results.json
+
+Job pages can be real pages recorded in an existing cache instead of generated ones, with --pages-from-cache.
+
+
+"""
+
+# Standard library imports
+import argparse
+import csv
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+# Related third party imports
+from termcolor import cprint
+
+
+# Local imports
+import cache
+from cache import *
+from functions import *
+from job_stages import *
+from pipeline import ConcurrencyController, Pipeline
+from tracing import tracer
+
+
+# The words the generated job pages are made from. The keyword check looks for search_words, so pages built without
+# them are filtered out like they would be on a real run
+search_words = ['python', 'javascript', 'react']
+must_have_words = []
+anti_kewords = ['on-site only']
+
+skill_words = [
+    'python', 'javascript', 'react', 'django', 'postgres', 'aws', 'docker', 'kubernetes', 'typescript', 'node.js',
+    'java', 'go', 'rust', 'c#', 'sql', 'terraform', 'graphql', 'redis', 'kafka', 'linux',
+]
+filler_words = [
+    'team', 'build', 'design', 'customers', 'product', 'scale', 'systems', 'platform', 'reliable', 'data', 'services',
+    'collaborate', 'ship', 'features', 'own', 'roadmap', 'quality', 'testing', 'review', 'mentor', 'growth',
+]
+
+benchmark_resume = """Skills:
+Python, Django, JavaScript, React, Postgres, AWS, Docker
+
+Experience:
+Senior Software Engineer, 6 years building web applications and data pipelines"""
+
+
+####
+#Fixtures
+####
+
+def make_sentence(rng, words, length):
+    return ' '.join(rng.choice(words) for _ in range(length)).capitalize() + '.'
+
+
+def make_job_page(number, paragraphs, rng):
+    # A job listing laid out like the real ones, with the sections the summary trimming drops. About one in four has
+    # none of the search words
+    skills = [word for word in skill_words if word not in search_words] if number % 4 == 3 else skill_words
+    sections = [
+        ('About the role', [make_sentence(rng, filler_words + skills, 20) for _ in range(paragraphs)]),
+        ('Requirements', [make_sentence(rng, skills, 6) for _ in range(4)]),
+        ('Benefits', ['Health insurance', 'Dental and vision', '401k matching', 'Unlimited PTO']),
+        ('Equal Opportunity', [f"Company {number} is an equal opportunity employer and provides reasonable accommodation."]),
+    ]
+    body = ''.join(
+        f"<h2>{heading}</h2>\n" + ''.join(f"<p>{paragraph}</p>\n" for paragraph in section)
+        for heading, section in sections
+    )
+    return (
+        f"<html><head><title>Software Engineer {number}</title></head><body>"
+        f"<nav><a href='/'>Home</a> <a href='/jobs'>Jobs</a></nav>"
+        f"<article><h1>Software Engineer {number}</h1>\n{body}</article>"
+        f"<footer>Copyright. All rights reserved. <a href='/privacy'>Privacy Policy</a></footer></body></html>"
+    )
+
+
+def load_recorded_pages(path, count):
+    # Real job pages from a cache.sqlite3, read directly so the benchmark's own cache isn't touched
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    rows = connection.execute(
+        "SELECT raw_html FROM pages WHERE raw_html IS NOT NULL AND body_text IS NOT NULL LIMIT ?", (count,)
+    ).fetchall()
+    connection.close()
+    return [decompress_html(row[0]) for row in rows]
+
+
+def make_feed(base_url, search_number, job_numbers):
+    # The channel links to a site that isn't searched, so every link the searches find is a job page and every one of
+    # them should end up in the report
+    items = ''.join(
+        f"<item><title>Software Engineer {job}</title><link>{base_url}/job/{job}</link></item>" for job in job_numbers
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f"<rss version=\"2.0\"><channel><title>Search {search_number}</title><link>https://jobs.example.com/</link>"
+        f"{items}</channel></rss>"
+    )
+
+
+####
+#The fixture server, serves the feeds and job pages, and answers OpenAI chat completion requests
+####
+
+def mock_completion(request):
+    # Replies in whatever shape the prompt asks for, with the rating picked from the prompt's hash so it's the same
+    # every run
+    prompt = request['messages'][-1]['content']
+    response_format = request.get('response_format') or {}
+    rating = int(hashlib.md5(prompt.encode('utf-8')).hexdigest(), 16) % 10 + 1
+    summary = "Required skills: " + ', '.join(word for word in skill_words if word in prompt.lower()) + '. ' + prompt[-200:]
+
+    if response_format.get('type') == 'json_schema':
+        content = json.dumps({'summary': summary, 'rating': rating})
+    elif response_format.get('type') == 'json_object':
+        jobs = re.findall(r'^JOB (\d+):', prompt, re.MULTILINE)
+        content = json.dumps({'ratings': [{'job': int(job), 'rating': (rating + int(job)) % 10 + 1} for job in jobs]})
+    elif 'REPLY WITH AN INTEGER' in prompt:
+        content = str(rating)
+    else:
+        content = summary
+
+    prompt_tokens, completion_tokens = len(prompt) // 4, len(content) // 4
+    return {
+        'id': f"chatcmpl-{rating}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': request.get('model', 'mock'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # The server object carries the fixtures and latencies, see start_fixture_server
+    protocol_version = 'HTTP/1.1'
+
+    # The headers and body go out in separate writes, without this each response sits waiting on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def send_body(self, body, content_type, status=200):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.page_latency)
+
+        path = urlparse(self.path).path
+        if path in self.server.feeds:
+            self.send_body(self.server.feeds[path], 'application/rss+xml; charset=utf-8')
+        elif path in self.server.pages:
+            self.send_body(self.server.pages[path], 'text/html; charset=utf-8')
+        else:
+            self.send_body('Not Found', 'text/plain', 404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.endswith('/chat/completions'):
+            self.send_body('{}', 'application/json', 404)
+            return
+
+        time.sleep(self.server.llm_latency)
+        self.send_body(json.dumps(mock_completion(request)), 'application/json')
+
+    def log_message(self, format, *args):
+        # Keep the request log out of the results
+        pass
+
+
+def make_certificate(directory):
+    # A throwaway certificate for 127.0.0.1. The search stage turns every link into https like it does for the real
+    # job sites, so the pages have to be served over TLS
+    certificate_path = os.path.join(directory, 'certificate.pem')
+    key_path = os.path.join(directory, 'key.pem')
+    try:
+        subprocess.run([
+            'openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+            '-keyout', key_path, '-out', certificate_path, '-days', '1', '-subj', '/CN=127.0.0.1',
+            '-addext', 'subjectAltName=IP:127.0.0.1',
+        ], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.exit(f"Couldn't make a certificate for the fixture server with openssl: {e}")
+    return certificate_path, key_path
+
+
+def start_fixture_server(settings, certificate):
+    # The pages are served over HTTPS with the throwaway certificate, which requests is told to trust. The mock
+    # OpenAI endpoint is plain HTTP on its own port, the OpenAI client keeps its own certificate store
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(*certificate)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    os.environ['REQUESTS_CA_BUNDLE'] = certificate[0]
+    base_url = f"https://127.0.0.1:{server.server_address[1]}"
+
+    llm_server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    llm_url = f"http://127.0.0.1:{llm_server.server_address[1]}"
+
+    # Job pages are either recorded or generated, the same ones for every run with the same seed
+    rng = random.Random(settings.seed)
+    if settings.pages_from_cache:
+        recorded = load_recorded_pages(settings.pages_from_cache, settings.jobs)
+        if not recorded:
+            sys.exit(f"No cached pages with text in {settings.pages_from_cache}")
+        job_pages = [recorded[number % len(recorded)] for number in range(settings.jobs)]
+    else:
+        job_pages = [make_job_page(number, settings.paragraphs, rng) for number in range(settings.jobs)]
+    server.pages = {f"/job/{number}": page for number, page in enumerate(job_pages)}
+
+    # Each search lists a random handful of the jobs, so searches overlap like they do on the real sites
+    server.feeds = {
+        f"/search/{number}": make_feed(base_url, number, rng.sample(range(settings.jobs), min(settings.jobs, settings.jobs_per_search)))
+        for number in range(settings.searches)
+    }
+
+    llm_server.pages = llm_server.feeds = {}
+
+    servers = [server, llm_server]
+    for each_server in servers:
+        each_server.daemon_threads = True
+        each_server.page_latency = settings.page_latency
+        each_server.llm_latency = settings.llm_latency
+        threading.Thread(target=each_server.serve_forever, daemon=True).start()
+    return servers, base_url, llm_url
+
+
+####
+#Running the stages
+####
+
+def stage_timings(stage):
+    # The stages overlap, so a stage's time runs from its first item starting to its last item finishing, and its time
+    # per item is how long its workers spent on each item on average
+    seconds = stage.last_finished - stage.first_started if stage.first_started else 0
+    return {
+        'items': stage.received,
+        'passed': stage.passed,
+        'failed': stage.failed,
+        'seconds': round(seconds, 4),
+        'busy_seconds': round(stage.busy_seconds, 4),
+        'seconds_per_item': round(stage.busy_seconds / stage.completed, 6) if stage.completed else None,
+        'items_per_second': round(stage.completed / seconds, 2) if seconds else None,
+        'workers': stage.limit,
+    }
+
+
+def write_report(links, path):
+    # The report step from scroop.py: read each link's rating and summary back from the cache and write the CSV
+    rows = []
+    for link in links:
+        rating = get_cached(link, 'rating')
+        summary = get_cached(link, 'summary')
+        if rating is None or summary is None:
+            continue
+        rows.append([datetime.now().strftime("%m-%d-%Y_%I-%M-%p"), int(rating.strip()), link, ' '.join(get_cluster_links(link))])
+
+    rows.sort(key=lambda row: row[1], reverse=True)
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Timestamp', 'Job Match Rating', 'Link', 'Also Posted At'])
+        writer.writerows(rows)
+    return rows
+
+
+def run_grid_point(threads, base_url, work_dir, settings):
+    # Every thread count starts from an empty cache, so nothing is reused from the run before
+    cache.cache_path = os.path.join(work_dir, f"cache_{threads}.sqlite3")
+    scanned_sites.clear()
+    run_links.clear()
+    near_duplicate_links.clear()
+
+    # The same stages scroop.py builds, set up the way the benchmark's settings ask
+    stage_settings.update({
+        'search_sites': [f"{base_url}/search/"],
+        'search_words': search_words,
+        'must_have_words': must_have_words,
+        'anti_kewords': anti_kewords,
+        'bullet_resume': benchmark_resume,
+        'open_ai_key': 'benchmark',
+        'threads': threads,
+        'llm_threads': settings.llm_threads or threads,
+        'adaptive_concurrency': settings.adaptive,
+        'max_threads': settings.max_threads,
+        'max_llm_threads': settings.max_threads,
+        'rating_batch_size': settings.rating_batch_size,
+        'combined_summary_rating': settings.combined_summary_rating,
+        'relevance_min_score': settings.relevance_min_score,
+        'near_duplicate_distance': settings.near_duplicate_distance,
+    })
+    stages = build_stages()
+    controller = ConcurrencyController() if settings.adaptive else None
+    pipeline = Pipeline(stages, controller=controller)
+
+    search_urls = [f"{base_url}/search/{number}" for number in range(settings.searches)]
+    pipeline_started = time.perf_counter()
+    links = pipeline.run(search_urls)
+    pipeline_seconds = time.perf_counter() - pipeline_started
+
+    stage_results = {stage.name: stage_timings(stage) for stage in stages}
+
+    # The report runs on one thread in scroop.py, so it does here too
+    report_started = time.perf_counter()
+    rows = write_report(links, os.path.join(work_dir, f"report_{threads}.csv"))
+    report_seconds = time.perf_counter() - report_started
+    stage_results['Report'] = {
+        'items': len(links),
+        'seconds': round(report_seconds, 4),
+        'seconds_per_item': round(report_seconds / len(links), 6) if links else None,
+        'rows': len(rows),
+    }
+
+    # A stage that fails is fast, so the failures and the links missing from the report are kept with the timings
+    total_seconds = pipeline_seconds + report_seconds
+    return {
+        'threads': threads,
+        'stages': stage_results,
+        'seconds': round(total_seconds, 4),
+        'seconds_per_link': round(total_seconds / settings.jobs, 6),
+        'failed': sum(stage.failed for stage in stages),
+        'report_rows': len(rows),
+        'missing_rows': len(links) - len(rows),
+    }
+
+
+def check_results(results):
+    # Counts the thread counts where something went wrong, the timings of a broken run don't mean anything
+    problems = 0
+    for result in results:
+        if result['failed'] or result['missing_rows'] or not result['report_rows']:
+            problems += 1
+            cprint(f"At {result['threads']} threads {result['failed']} items failed and {result['missing_rows']} links are missing from the report ({result['report_rows']} rows)", 'red')
+    return problems
+
+
+def add_speedups(results):
+    # How much faster each thread count is than the first one in the grid, for the whole run and each stage
+    baseline = results[0]
+    for result in results:
+        result['speedup'] = round(baseline['seconds'] / result['seconds'], 2) if result['seconds'] else None
+        for name, stage in result['stages'].items():
+            base_stage = baseline['stages'].get(name)
+            stage['speedup'] = round(base_stage['seconds'] / stage['seconds'], 2) if base_stage and stage['seconds'] else None
+
+
+def print_table(results):
+    # The same layout as the thread table in the README
+    print("Threads | Seconds/Item | Faster Than 1 Thread")
+    print("-------- | -------- | --------")
+    for result in results:
+        speedup = f"~{result['speedup']}x" if result is not results[0] else ''
+        print(f"{result['threads']} | {result['seconds_per_link']} | {speedup}")
+
+
+def compare_results(previous, results, tolerance):
+    # Flags every stage and thread count that's slower than in the previous results by more than the tolerance
+    previous = {result['threads']: result for result in previous['results']}
+
+    regressions = 0
+    for result in results:
+        old = previous.get(result['threads'])
+        if old is None:
+            continue
+
+        # Fewer rows or more failures than before is a regression whatever the timings say
+        if result['failed'] > old.get('failed', 0) or result['report_rows'] < old.get('report_rows', 0):
+            regressions += 1
+            cprint(f"At {result['threads']} threads {result['failed']} items failed and the report has {result['report_rows']} rows, before it was {old.get('failed', 0)} and {old.get('report_rows', 0)}", 'red')
+
+        for name, stage in result['stages'].items():
+            old_stage = old['stages'].get(name)
+            if not old_stage or not old_stage.get('seconds_per_item') or not stage.get('seconds_per_item'):
+                continue
+            change = stage['seconds_per_item'] / old_stage['seconds_per_item'] - 1
+            if change > tolerance:
+                regressions += 1
+                cprint(f"{name} at {result['threads']} threads is {round(change * 100)}% slower ({old_stage['seconds_per_item']} -> {stage['seconds_per_item']} seconds per item)", 'red')
+            elif change < -tolerance:
+                cprint(f"{name} at {result['threads']} threads is {round(-change * 100)}% faster", 'green')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scroop's stages against a local fixture server and a mock OpenAI endpoint")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16], help="thread counts to run, the first is the baseline")
+    parser.add_argument('--llm-threads', type=int, help="workers for the OpenAI stages, the same as --threads if not set")
+    parser.add_argument('--adaptive', action='store_true', help="tune the worker counts as the run goes, with the thread counts as starting points")
+    parser.add_argument('--max-threads', type=int, default=32, help="the most workers --adaptive can give a stage")
+    parser.add_argument('--rating-batch-size', type=int, default=10, help="jobs rated in each OpenAI request")
+    parser.add_argument('--combined-summary-rating', action='store_true', help="summarize and rate each job in one request")
+    parser.add_argument('--near-duplicate-distance', type=int, default=3, help="fingerprint bits two copies of a job can differ by, 0 turns it off")
+    parser.add_argument('--relevance-min-score', type=float, default=0, help="drop pages under this fraction of the best relevance score")
+    parser.add_argument('--searches', type=int, default=20, help="search feeds served")
+    parser.add_argument('--jobs', type=int, default=100, help="job pages served")
+    parser.add_argument('--jobs-per-search', type=int, default=15, help="job links in each search feed")
+    parser.add_argument('--paragraphs', type=int, default=8, help="paragraphs in each generated job page")
+    parser.add_argument('--pages-from-cache', help="a cache.sqlite3 to take real job pages from, instead of generating them")
+    parser.add_argument('--page-latency', type=float, default=0.05, help="seconds the server waits before each page")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="seconds the mock OpenAI waits before each reply")
+    parser.add_argument('--seed', type=int, default=1, help="seed for the generated pages and feeds")
+    parser.add_argument('--output', default='benchmark_results.json', help="where the results are written")
+    parser.add_argument('--compare', help="earlier results to check for regressions against")
+    parser.add_argument('--processes', type=int, default=0, help="extraction processes, 0 extracts in the threads")
+    parser.add_argument('--trace', help="write a trace of the benchmark runs to this file, for ui.perfetto.dev")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="how much slower a stage can get before it counts as a regression")
+    settings = parser.parse_args()
+
+    # Read the earlier results first, they may be about to be overwritten
+    previous = None
+    if settings.compare:
+        with open(settings.compare) as file:
+            previous = json.load(file)
+
+    # Forked before the fixture server's threads start
+    start_extraction_pool(settings.processes)
+
+    if settings.trace:
+        tracer.enable()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        servers, base_url, llm_url = start_fixture_server(settings, make_certificate(work_dir))
+
+        # Fetch straight from the fixture server with no politeness delays, and point OpenAI at the mock with limits
+        # high enough that the rate limiter never waits, so the timings are scroop's own work
+        domain_fetch_modes[urlparse(base_url).netloc] = 'http'
+        domain_scheduler.configure(max_per_domain=max(settings.threads + [settings.max_threads]), min_delay=0)
+        openai_settings['base_url'] = f"{llm_url}/v1"
+        openai_rate_limiter.configure(10 ** 9, 10 ** 12)
+
+        for threads in settings.threads:
+            print(f"Running with {threads} threads...")
+            result = run_grid_point(threads, base_url, work_dir, settings)
+            results.append(result)
+            print(f"\t{result['seconds']} seconds, " + ', '.join(f"{name} {stage['seconds']}" for name, stage in result['stages'].items()))
+
+        for server in servers:
+            server.shutdown()
+    add_speedups(results)
+
+    if settings.trace:
+        tracer.write(settings.trace)
+
+    output = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': vars(settings),
+        'results': results,
+    }
+    with open(settings.output, 'w') as file:
+        json.dump(output, file, indent=2)
+    print(f"\nResults written to {settings.output}\n")
+
+    print_table(results)
+
+    problems = check_results(results)
+    regressions = compare_results(previous, results, settings.tolerance) if previous else 0
+    if problems or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,87 @@
 open_ai_key = ""
 
+# Leave as None to use OpenAI, or set to the URL of any OpenAI compatible server, for example "http://localhost:8000/v1"
+openai_base_url = None
+
+# The rate limits on your OpenAI account, see https://platform.openai.com/account/limits. Requests are spaced out to
+# stay under these, so raising llm_threads doesn't run into errors
+openai_requests_per_minute = 500
+openai_tokens_per_minute = 200000
+
+# How many job summaries are rated together in one OpenAI request, so the resume is sent once per batch instead of once
+# per job. Set to 1 to rate each job on its own
+rating_batch_size = 10
+
+# Summarize and rate each job in a single OpenAI request, with the reply in a fixed JSON format, instead of a summary
+# request followed by a rating request. Half the requests, but the resume is sent with every job, so rating_batch_size
+# doesn't apply
+combined_summary_rating = False
+
+# Before a page is summarized, the benefits, company blurb, legal text, and repeated paragraphs are dropped and the rest
+# is capped at summary_max_tokens tokens. Set to 0 for no cap
+summary_max_tokens = 3000
+
 
 threads = 8
 
+# How many OpenAI requests can be running at once. These are waiting on the network rather than using the computer,
+# so this can be higher than threads
+llm_threads = 8
+
+# Let scroop tune the number of workers as it runs. Every few seconds each busy stage gets another worker if that keeps
+# paying off, and is cut back when it stops helping (fewer items a second, or each item taking much longer) or when
+# memory use goes over adaptive_memory_limit percent. threads and llm_threads are where it starts, and it stays between
+# min_threads and max_threads (max_llm_threads for the OpenAI stages)
+adaptive_concurrency = True
+min_threads = 1
+max_threads = 32
+max_llm_threads = 32
+adaptive_memory_limit = 90
+
+# How many processes parse the pages and extract their text, so that CPU work isn't squeezed into one core with all the
+# threads. Around the number of CPU cores is a good start. Set to 0 to do it in the threads (also what happens on
+# systems without fork, like Windows)
+extraction_processes = 4
+
+# Politeness for each job site: at most this many pages from one site are fetched at once, fetches from the same site
+# start at least this many seconds apart, and the delay doubles with each failure in a row
+domain_max_concurrency = 2
+domain_min_delay = 1.0
+
+# How many Chrome browsers can be open at once, shared by all the threads. Chrome is the main memory hog, so this
+# can be lower than threads if you're running out of RAM. Each browser is restarted after browser_max_pages pages
+browsers = 8
+browser_max_pages = 50
+
+# The longest to wait for a page to finish rendering in the browser, in seconds. Pages are normally used as soon as
+# they stop changing, this is only the limit for slow sites
+page_load_timeout = 15
+
+# Optional CSS selectors that mean a site's page has loaded, keyed by domain, for sites where waiting for the page to
+# stop changing isn't reliable. For example {'www.linkedin.com': '.jobs-search__results-list'}
+readiness_selectors = {}
+
+# Cached pages are compressed on disk. 'zstd' is the smallest and fastest but needs `pip install zstandard`, 'gzip'
+# works everywhere, and 'none' turns compression off. Higher levels are smaller and slower (gzip goes up to 9,
+# zstd up to 22)
+cache_compression = 'gzip'
+cache_compression_level = 6
+
+# Links that have been scanned are skipped on later runs. After this many days they're forgotten and get looked at again
+# if they show up in a search, 0 remembers them forever
+seen_link_expire_days = 0
+
+# At the end of every run, counts and timings for the fetches, keyword checks, OpenAI requests, and stages are written
+# to metrics_file in the Prometheus text format (point the node exporter's textfile collector at it) and to
+# metrics_json_file as JSON. Set either to "" to skip it
+metrics_file = "scroop.prom"
+metrics_json_file = "scroop_metrics.json"
+
+# Write a trace of the run to trace_file, showing what every thread and every link spent its time on (fetching, waiting
+# on the browser, extracting text, checking keywords, OpenAI requests, the cache). Open it at ui.perfetto.dev or in
+# chrome://tracing. It's cheap enough to leave on, set to "" to turn it off
+trace_file = ""
+
 # Enable debug mode to only process 10 links and turn on some extra print statements
 debug = False
 
@@ -24,6 +103,18 @@ search_sites = [
     'https://jobs.springboardforthearts.org/jobs?keywords=',
 ]
 
+# How each search site's pages are fetched, keyed by domain. 'http' is a plain download, which is all RSS feeds need and is
+# far faster than a browser. 'selenium' always opens the page in Chrome, for sites that need JavaScript. Any domain that
+# isn't listed is fetched over plain HTTP first and only opened in Chrome if the page looks like it needs JavaScript
+fetch_modes = {
+    'jobs.chronicle.com': 'http',
+    'careers.insidehighered.com': 'http',
+    'www.timeshighereducation.com': 'http',
+    'main.hercjobs.org': 'http',
+    'academiccareers.com': 'http',
+    'www.indeed.com': 'selenium',
+}
+
 
 search_words = [
     '"web developer"',
@@ -32,6 +123,11 @@ search_words = [
     'javascript',
     ]
 
+# Keywords match anywhere in a word by default, so "engineer" also matches "engineering". Set to True to only match
+# whole words, so "book" doesn't match "facebook" (but "remote" won't match "remotely" either, so check your keywords
+# still find the jobs you want). Words in double quotes are matched as a phrase either way
+keyword_word_boundaries = False
+
 # this word is not searched for, but is used to filter out jobs that don't meet some criteria. 
 # you can also leave this blank by setting it to an empty list ie []
 must_have_words = [ 
@@ -56,6 +152,20 @@ anti_kewords = [
     "NON-HYBRID",
 ]
 
+# Optionally, before any OpenAI requests, the pages that passed the keyword check are scored against the resume (BM25,
+# run locally) and the weak matches are dropped. relevance_min_score is a fraction of the best score in the run, so
+# 0.15 drops pages that score under 15% of the best one. relevance_top_k keeps only that many of the best pages. Both
+# at 0 (the default) sends every page to OpenAI. Turning either on waits for every page to be checked for keywords
+# before any summaries start, and since the scores are relative to the run a job can pass one run and not the next.
+# The dropped links are listed as the run goes
+relevance_min_score = 0
+relevance_top_k = 0
+
+# The same job is often posted on several sites, or reposted with a new link. Pages whose text is nearly the same
+# (SimHash, compared across runs) only go to OpenAI once, and the report lists the other links under the first one.
+# near_duplicate_distance is how many of the 64 fingerprint bits can differ, up to 3. Set to 0 to turn it off
+near_duplicate_distance = 3
+
 bullet_resume = """Education:
 B.S. Computer Science, University of Georgia
 
@@ -0,0 +1,638 @@
+
+# Standard library imports
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+# Local imports
+from tracing import tracer
+
+
+# Optional, zstd compresses HTML better and faster than gzip when it's installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Everything cached about a link lives in one row of this database, keyed by the md5 of the URL, which is the same
+# name the old cached_pages files used so they can be imported as is
+cache_path = 'cache.sqlite3'
+
+# Each cached value and the column that records when it was written
+cache_fields = {
+    'raw_html': 'fetched_at',
+    'body_text': 'extracted_at',
+    'page_links': 'linked_at',
+    'summary': 'summarized_at',
+    'rating': 'rated_at',
+}
+
+# Values worked out from the raw HTML. They go stale when the HTML is replaced with HTML that's actually different,
+# which is checked with content_hash, a hash of the HTML. The extracted text also records text_extractor, the
+# version of the code that extracted it, so upgrading the extractor re-extracts the text
+derived_fields = ['body_text', 'page_links', 'text_extractor']
+
+# Columns added after the tables were first created, added to older databases when they're opened
+cache_added_columns = [
+    ('page_links', 'TEXT'),
+    ('linked_at', 'REAL'),
+    ('content_hash', 'TEXT'),
+    ('text_extractor', 'TEXT'),
+]
+
+# The same for the runs table
+run_added_columns = [
+    ('status', "TEXT DEFAULT 'running'"),
+]
+
+cache_schema = """
+CREATE TABLE IF NOT EXISTS pages (
+    url_hash TEXT PRIMARY KEY,
+    url TEXT,
+    raw_html TEXT,
+    fetched_at REAL,
+    body_text TEXT,
+    extracted_at REAL,
+    summary TEXT,
+    summarized_at REAL,
+    rating TEXT,
+    rated_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS removed_pages (
+    url_hash TEXT,
+    url TEXT,
+    raw_html TEXT,
+    fetched_at REAL,
+    body_text TEXT,
+    extracted_at REAL,
+    summary TEXT,
+    summarized_at REAL,
+    rating TEXT,
+    rated_at REAL,
+    removed_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS seen_links (
+    url TEXT PRIMARY KEY,
+    status TEXT,
+    first_seen REAL,
+    updated_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS seen_links_updated_at ON seen_links (updated_at);
+
+CREATE TABLE IF NOT EXISTS fingerprints (
+    url TEXT PRIMARY KEY,
+    simhash INTEGER,
+    band0 INTEGER,
+    band1 INTEGER,
+    band2 INTEGER,
+    band3 INTEGER,
+    representative TEXT,
+    created_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS fingerprints_band0 ON fingerprints (band0);
+CREATE INDEX IF NOT EXISTS fingerprints_band1 ON fingerprints (band1);
+CREATE INDEX IF NOT EXISTS fingerprints_band2 ON fingerprints (band2);
+CREATE INDEX IF NOT EXISTS fingerprints_band3 ON fingerprints (band3);
+CREATE INDEX IF NOT EXISTS fingerprints_representative ON fingerprints (representative);
+
+CREATE TABLE IF NOT EXISTS llm_results (
+    key TEXT PRIMARY KEY,
+    kind TEXT,
+    result TEXT,
+    created_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL,
+    finished_at REAL,
+    status TEXT DEFAULT 'running'
+);
+
+CREATE TABLE IF NOT EXISTS run_links (
+    run_id INTEGER,
+    url TEXT,
+    stage TEXT,
+    position INTEGER,
+    status TEXT,
+    updated_at REAL,
+    PRIMARY KEY (run_id, url)
+);
+
+CREATE TABLE IF NOT EXISTS run_searches (
+    run_id INTEGER,
+    url TEXT,
+    updated_at REAL,
+    PRIMARY KEY (run_id, url)
+);
+
+CREATE TABLE IF NOT EXISTS cache_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# How the raw HTML is compressed in the cache: 'zstd', 'gzip', or 'none'. Compressed pages are recognised by their
+# header when they're read, so changing this only affects pages cached from then on
+cache_settings = {
+    'compression': 'gzip',
+    'level': 6,
+}
+
+# Every zstd and gzip stream starts with these bytes
+zstd_magic = b'\x28\xb5\x2f\xfd'
+gzip_magic = b'\x1f\x8b'
+
+# SQLite connections can't be shared between threads, so each thread opens its own
+cache_local = threading.local()
+cache_schema_lock = threading.Lock()
+cache_schema_ready = set()
+
+
+def get_cache_connection():
+    connection = getattr(cache_local, 'connection', None)
+    if connection is None or getattr(cache_local, 'path', None) != cache_path:
+        # Autocommit mode, every write is a single statement so each one is atomic on its own
+        connection = sqlite3.connect(cache_path, timeout=30, isolation_level=None)
+
+        # WAL lets the reader threads carry on while another thread writes
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=30000")
+
+        # Only the first connection to a database needs to create the tables
+        with cache_schema_lock:
+            if cache_path not in cache_schema_ready:
+                connection.executescript(cache_schema)
+                add_missing_columns(connection)
+                cache_schema_ready.add(cache_path)
+
+        cache_local.connection = connection
+        cache_local.path = cache_path
+    return connection
+
+
+def add_missing_columns(connection):
+    # Both tables get the same columns, removed_pages is a copy of pages with a removed_at on the end
+    for table in ('pages', 'removed_pages'):
+        existing = {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+        for column, column_type in cache_added_columns:
+            if column not in existing:
+                connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    existing = {row[1] for row in connection.execute("PRAGMA table_info(runs)")}
+    for column, column_type in run_added_columns:
+        if column not in existing:
+            connection.execute(f"ALTER TABLE runs ADD COLUMN {column} {column_type}")
+
+
+def compress_html(raw_html):
+    compression = cache_settings['compression']
+    if compression == 'zstd' and zstandard is None:
+        compression = 'gzip'
+
+    data = raw_html.encode('utf-8', errors='replace')
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=cache_settings['level']).compress(data)
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=min(9, max(1, cache_settings['level'])))
+    return raw_html
+
+
+def decompress_html(stored):
+    # Uncompressed pages come back from SQLite as text, compressed ones as bytes
+    if isinstance(stored, str):
+        return stored
+    if stored.startswith(zstd_magic):
+        if zstandard is None:
+            raise RuntimeError("This page was cached with zstd compression, install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompress(stored).decode('utf-8', errors='replace')
+    if stored.startswith(gzip_magic):
+        return gzip.decompress(stored).decode('utf-8', errors='replace')
+    return stored.decode('utf-8', errors='replace')
+
+
+def url_hash(url):
+    return hashlib.md5(url.encode()).hexdigest()
+
+
+def content_hash(raw_html):
+    return hashlib.sha1(raw_html.encode(errors='replace')).hexdigest()
+
+
+def get_cached(url, field, max_age=None):
+    # max_age is in seconds, None or a negative age means the value never goes stale
+    timestamp_field = cache_fields[field]
+    with tracer.span('cache read', 'cache', field=field):
+        row = get_cache_connection().execute(
+            f"SELECT {field}, {timestamp_field} FROM pages WHERE url_hash = ?", (url_hash(url),)
+        ).fetchone()
+
+    if row is None or row[0] is None:
+        return None
+
+    value, written_at = row
+    if max_age is not None and max_age >= 0 and time.time() - (written_at or 0) > max_age:
+        return None
+
+    if field == 'raw_html':
+        with tracer.span('decompress html', 'cache'):
+            return decompress_html(value)
+
+    return value
+
+
+def set_cached(url, field, value):
+    timestamp_field = cache_fields[field]
+
+    if field != 'raw_html':
+        with tracer.span('cache write', 'cache', field=field):
+            get_cache_connection().execute(
+                f"""INSERT INTO pages (url_hash, url, {field}, {timestamp_field}) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(url_hash) DO UPDATE SET
+                        url = excluded.url, {field} = excluded.{field}, {timestamp_field} = excluded.{timestamp_field}""",
+                (url_hash(url), url, value, time.time()),
+            )
+        return
+
+    # New HTML that's different from the old HTML makes everything worked out from the old HTML stale, a page that
+    # was fetched again and hasn't changed keeps it
+    keep_if_unchanged = "".join(
+        f", {column} = CASE WHEN pages.content_hash = excluded.content_hash THEN pages.{column} ELSE NULL END"
+        for derived in derived_fields
+        for column in dict.fromkeys([derived, cache_fields.get(derived, derived)])
+    )
+    with tracer.span('compress html', 'cache'):
+        compressed_html = compress_html(value)
+    with tracer.span('cache write', 'cache', field=field):
+        get_cache_connection().execute(
+            f"""INSERT INTO pages (url_hash, url, raw_html, fetched_at, content_hash) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(url_hash) DO UPDATE SET
+                    url = excluded.url, raw_html = excluded.raw_html, fetched_at = excluded.fetched_at{keep_if_unchanged},
+                    content_hash = excluded.content_hash""",
+            (url_hash(url), url, compressed_html, time.time(), content_hash(value)),
+        )
+
+
+def get_cached_text(url, extractor, max_age=None):
+    # The extracted text for the page's current HTML, without loading the HTML. max_age applies to when the HTML
+    # was fetched, like get_cached(url, 'raw_html', max_age)
+    with tracer.span('cache read', 'cache', field='body_text'):
+        row = get_cache_connection().execute(
+            "SELECT body_text, fetched_at FROM pages WHERE url_hash = ? AND text_extractor = ? AND raw_html IS NOT NULL",
+            (url_hash(url), extractor),
+        ).fetchone()
+
+    if row is None or row[0] is None:
+        return None
+
+    text, fetched_at = row
+    if max_age is not None and max_age >= 0 and time.time() - (fetched_at or 0) > max_age:
+        return None
+
+    return text
+
+
+def get_llm_result(key):
+    # An OpenAI reply saved under the hash of everything that went into the request, see llm_cache_key
+    with tracer.span('cache read', 'cache', field='llm_result'):
+        row = get_cache_connection().execute("SELECT result FROM llm_results WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_llm_result(key, kind, result):
+    with tracer.span('cache write', 'cache', field='llm_result'):
+        get_cache_connection().execute(
+            "INSERT OR REPLACE INTO llm_results (key, kind, result, created_at) VALUES (?, ?, ?, ?)",
+            (key, kind, result, time.time()),
+        )
+
+
+def set_cached_text(url, text, extractor, hashed_html):
+    # Only saved if the HTML it came from is still the cached HTML. Pages imported from the old cache folder don't
+    # have a hash yet, so they get the one the text was extracted against
+    with tracer.span('cache write', 'cache', field='body_text'):
+        get_cache_connection().execute(
+            """UPDATE pages SET body_text = ?, extracted_at = ?, text_extractor = ?, content_hash = ?
+               WHERE url_hash = ? AND (content_hash = ? OR content_hash IS NULL)""",
+            (text, time.time(), extractor, hashed_html, url_hash(url), hashed_html),
+        )
+
+
+def remove_cached(url):
+    # Keep a copy of what was removed, in case it needs a look later, then drop it from the cache. The columns are
+    # named since columns added later can be in a different order in the two tables
+    connection = get_cache_connection()
+    page_columns = ', '.join(row[1] for row in connection.execute("PRAGMA table_info(pages)"))
+    removed_columns = f"{page_columns}, removed_at"
+    hashed = url_hash(url)
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute(
+            f"INSERT INTO removed_pages ({removed_columns}) SELECT {page_columns}, ? FROM pages WHERE url_hash = ?", (time.time(), hashed)
+        )
+        removed = connection.execute("DELETE FROM pages WHERE url_hash = ?", (hashed,)).rowcount
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    return removed > 0
+
+
+def migrate_cached_pages(directory='cached_pages', debug=False):
+    # Only import the old cache folder once
+    connection = get_cache_connection()
+    if not os.path.isdir(directory) or connection.execute(
+        "SELECT 1 FROM cache_meta WHERE key = 'cached_pages_migrated'"
+    ).fetchone():
+        return 0
+
+    # The file name says which column the contents belong in, and the modified time is when it was written
+    suffixes = {'': 'raw_html', '_summary.txt': 'summary', '_rating.txt': 'rating'}
+    rows = {field: [] for field in suffixes.values()}
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            hashed, field = entry.name[:32], suffixes.get(entry.name[32:])
+            if field is None or len(hashed) != 32:
+                continue
+            with open(entry.path, 'r', errors='replace') as file:
+                rows[field].append((hashed, file.read(), entry.stat().st_mtime))
+
+    # One transaction for the whole import, it's far faster than a commit per file
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        for field, field_rows in rows.items():
+            timestamp_field = cache_fields[field]
+            connection.executemany(
+                f"""INSERT INTO pages (url_hash, {field}, {timestamp_field}) VALUES (?, ?, ?)
+                    ON CONFLICT(url_hash) DO UPDATE SET
+                        {field} = excluded.{field}, {timestamp_field} = excluded.{timestamp_field}""",
+                field_rows,
+            )
+        connection.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES ('cached_pages_migrated', ?)", (str(time.time()),))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+    imported = sum(len(field_rows) for field_rows in rows.values())
+    if debug:
+        print(f"Imported {imported} files from {directory} into {cache_path}")
+
+    return imported
+
+
+# Statuses a seen link can have. Filtered links didn't have the keywords, rated links made it all the way to the
+# report, failed links hit an error and are tried again next run, duplicate links are the same job as another link,
+# and imported links came from scanned_sites.log
+seen_link_statuses = ('filtered', 'rated', 'failed', 'duplicate', 'imported')
+
+
+def mark_seen(url, status):
+    now = time.time()
+    get_cache_connection().execute(
+        """INSERT INTO seen_links (url, status, first_seen, updated_at) VALUES (?, ?, ?, ?)
+           ON CONFLICT(url) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at""",
+        (url, status, now, now),
+    )
+
+
+def is_seen(url, statuses=None):
+    # Failed links don't count unless asked for, so they get another try
+    if statuses is None:
+        statuses = [status for status in seen_link_statuses if status != 'failed']
+    placeholders = ', '.join('?' for _ in statuses)
+    return get_cache_connection().execute(
+        f"SELECT 1 FROM seen_links WHERE url = ? AND status IN ({placeholders})", [url, *statuses]
+    ).fetchone() is not None
+
+
+def load_seen_links(statuses=None):
+    # One query for the whole set, for filtering a big list of links at once
+    if statuses is None:
+        statuses = [status for status in seen_link_statuses if status != 'failed']
+    placeholders = ', '.join('?' for _ in statuses)
+    rows = get_cache_connection().execute(
+        f"SELECT url FROM seen_links WHERE status IN ({placeholders})", list(statuses)
+    )
+    return {row[0] for row in rows}
+
+
+def expire_seen_links(max_age_days):
+    # Forget links that haven't been touched in max_age_days, so old postings that come back get another look
+    if not max_age_days or max_age_days <= 0:
+        return 0
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    return get_cache_connection().execute("DELETE FROM seen_links WHERE updated_at < ?", (cutoff,)).rowcount
+
+
+def migrate_scanned_sites_log(path='scanned_sites.log', debug=False):
+    # Only import the old log once
+    connection = get_cache_connection()
+    if not os.path.isfile(path) or connection.execute(
+        "SELECT 1 FROM cache_meta WHERE key = 'scanned_sites_migrated'"
+    ).fetchone():
+        return 0
+
+    # The log has no dates, so everything in it is counted as seen when the log was last written
+    written_at = os.path.getmtime(path)
+    with open(path, 'r', errors='replace') as file:
+        urls = {line.strip() for line in file if line.strip()}
+
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.executemany(
+            "INSERT OR IGNORE INTO seen_links (url, status, first_seen, updated_at) VALUES (?, 'imported', ?, ?)",
+            [(url, written_at, written_at) for url in urls],
+        )
+        connection.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES ('scanned_sites_migrated', ?)", (str(time.time()),))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+    if debug:
+        print(f"Imported {len(urls)} links from {path} into {cache_path}")
+
+    return len(urls)
+
+
+def compress_cached_pages(debug=False):
+    # Compress the pages that were cached before compression was turned on, a batch at a time. This only happens once
+    if cache_settings['compression'] == 'none':
+        return 0
+    connection = get_cache_connection()
+    if connection.execute("SELECT 1 FROM cache_meta WHERE key = 'raw_html_compressed'").fetchone():
+        return 0
+
+    compressed = 0
+    last_rowid = 0
+    while True:
+        rows = connection.execute(
+            "SELECT rowid, raw_html FROM pages WHERE rowid > ? AND typeof(raw_html) = 'text' ORDER BY rowid LIMIT 500",
+            (last_rowid,),
+        ).fetchall()
+        if not rows:
+            break
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "UPDATE pages SET raw_html = ? WHERE rowid = ?",
+                [(compress_html(raw_html), rowid) for rowid, raw_html in rows],
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        compressed += len(rows)
+        last_rowid = rows[-1][0]
+
+    connection.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES ('raw_html_compressed', ?)", (str(time.time()),))
+
+    # Hand the space the uncompressed pages used back to the disk
+    if compressed:
+        connection.execute("VACUUM")
+
+    if debug:
+        print(f"Compressed {compressed} cached pages")
+
+    return compressed
+
+
+def fingerprint_bands(simhash):
+    # The 64 bit fingerprint split into four 16 bit bands. Two fingerprints that differ in 3 bits or fewer have at
+    # least one band exactly the same, so only links sharing a band need to be compared
+    return [(simhash >> (16 * band)) & 0xFFFF for band in range(4)]
+
+
+def signed_64(number):
+    # SQLite integers are signed
+    return number - (1 << 64) if number >= 1 << 63 else number
+
+
+def find_near_duplicate(url, simhash, max_distance=3):
+    # Returns the representative link of the closest fingerprint within max_distance bits, other than url's own
+    bands = fingerprint_bands(simhash)
+    rows = get_cache_connection().execute(
+        """SELECT url, simhash, representative FROM fingerprints
+           WHERE (band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?) AND url != ?""",
+        (*bands, url),
+    ).fetchall()
+
+    best = None
+    for other_url, other_simhash, representative in rows:
+        distance = bin((other_simhash & 0xFFFFFFFFFFFFFFFF) ^ simhash).count('1')
+        if distance <= max_distance and (best is None or distance < best[0]):
+            best = (distance, representative or other_url)
+
+    return best[1] if best else None
+
+
+def save_fingerprint(url, simhash, representative):
+    get_cache_connection().execute(
+        """INSERT INTO fingerprints (url, simhash, band0, band1, band2, band3, representative, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT(url) DO UPDATE SET
+               simhash = excluded.simhash, band0 = excluded.band0, band1 = excluded.band1, band2 = excluded.band2,
+               band3 = excluded.band3, representative = excluded.representative""",
+        (url, signed_64(simhash), *fingerprint_bands(simhash), representative, time.time()),
+    )
+
+
+def get_cluster_links(representative):
+    # Every link that's a duplicate of the representative, not including the representative itself
+    rows = get_cache_connection().execute(
+        "SELECT url FROM fingerprints WHERE representative = ? AND url != ? ORDER BY created_at", (representative, representative)
+    )
+    return [row[0] for row in rows]
+
+
+def move_cluster(representative, new_representative):
+    # Make another link the representative of the group, including for the old representative's own fingerprint
+    get_cache_connection().execute(
+        "UPDATE fingerprints SET representative = ? WHERE representative = ? OR url = ?",
+        (new_representative, representative, representative),
+    )
+
+
+def forget_cluster(representative):
+    # Break up the group when the representative didn't make it to the report, so its duplicates aren't lost with it.
+    # The next copy of the job that turns up becomes the representative
+    get_cache_connection().execute("DELETE FROM fingerprints WHERE representative = ? OR url = ?", (representative, representative))
+
+
+# The run manifest records how far each link got in the current run, so a run that dies partway through can pick up
+# where it stopped. A link's row only moves forward: position is the stage's place in the pipeline, and a link found
+# by two searches, or dropped as a duplicate after it was already passed on, keeps the furthest stage it reached. The
+# finished searches are kept in their own table, since a search page can turn up as a link too
+def start_run():
+    # A new run gives up on any earlier run that didn't finish, it can't be resumed after this one has started
+    connection = get_cache_connection()
+    for (run_id,) in connection.execute("SELECT run_id FROM runs WHERE status = 'running'").fetchall():
+        end_run(run_id, 'abandoned')
+
+    cursor = connection.execute("INSERT INTO runs (started_at, status) VALUES (?, 'running')", (time.time(),))
+    return cursor.lastrowid
+
+
+def get_unfinished_run():
+    # The most recent run that didn't get as far as the report
+    row = get_cache_connection().execute(
+        "SELECT run_id FROM runs WHERE status = 'running' ORDER BY run_id DESC LIMIT 1"
+    ).fetchone()
+    return row[0] if row else None
+
+
+def end_run(run_id, status):
+    # Once the run is over its manifest isn't needed anymore, a finished run's links are in the seen links
+    connection = get_cache_connection()
+    connection.execute("UPDATE runs SET finished_at = ?, status = ? WHERE run_id = ?", (time.time(), status, run_id))
+    connection.execute("DELETE FROM run_links WHERE run_id = ?", (run_id,))
+    connection.execute("DELETE FROM run_searches WHERE run_id = ?", (run_id,))
+
+
+def finish_run(run_id):
+    end_run(run_id, 'finished')
+
+
+def record_run_link(run_id, url, stage, position, status):
+    get_cache_connection().execute(
+        """INSERT INTO run_links (run_id, url, stage, position, status, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT(run_id, url) DO UPDATE SET
+               stage = excluded.stage, position = excluded.position, status = excluded.status, updated_at = excluded.updated_at
+           WHERE excluded.position > run_links.position""",
+        (run_id, url, stage, position, status, time.time()),
+    )
+
+
+def load_run_links(run_id):
+    # (url, stage, status) for every link recorded in the run
+    return get_cache_connection().execute(
+        "SELECT url, stage, status FROM run_links WHERE run_id = ? ORDER BY updated_at", (run_id,)
+    ).fetchall()
+
+
+def record_run_search(run_id, url):
+    get_cache_connection().execute(
+        "INSERT OR REPLACE INTO run_searches (run_id, url, updated_at) VALUES (?, ?, ?)", (run_id, url, time.time())
+    )
+
+
+def load_run_searches(run_id):
+    # The search pages the run finished
+    rows = get_cache_connection().execute("SELECT url FROM run_searches WHERE run_id = ?", (run_id,))
+    return {row[0] for row in rows}
@@ -1,25 +1,47 @@
 
 # Standard library imports
+import atexit
 import hashlib
+import json
+import math
+import multiprocessing
 import os
 import random
 import re
+import threading
 import time
-from urllib.parse import urlparse, quote, unquote, urljoin, urlunparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import urlparse, quote, unquote, urlsplit, urlunsplit
 
 
 # Related third party imports
 from bs4 import BeautifulSoup
 from fake_useragent import UserAgent
-from openai import OpenAI
+from lxml import etree
+from lxml import html as lxml_html
+from openai import OpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+import requests
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.action_chains import ActionChains
 from termcolor import cprint
+import tiktoken
 from trafilatura import extract
+from trafilatura import __version__ as trafilatura_version
 from webdriver_manager.chrome import ChromeDriverManager
 
+# Local imports
+from cache import get_cached, set_cached, get_cached_text, set_cached_text, content_hash, mark_seen, is_seen
+from cache import find_near_duplicate, save_fingerprint, move_cluster, get_llm_result, set_llm_result
+from metrics import metrics
+from tracing import tracer
+
 
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
@@ -27,6 +49,11 @@ import re
 
 
 
+# Saved alongside the extracted text, so text from an older trafilatura, or from before a change to the cleanup in
+# get_page_body_text, is extracted again. Bump the cleanup number whenever get_page_body_text changes what it returns
+text_extractor_version = f"trafilatura {trafilatura_version}, cleanup 1"
+
+
 def get_page_body_text(raw_page, full_text=False, debug=False):
     if debug:
         cprint("get_page_body_text","yellow")
@@ -52,7 +79,238 @@ def get_page_body_text(raw_page, full_text=False, debug=False):
     return clean_text
 
 
-def get_page_content(driver, url, cache_age=72, debug=False):
+# Which fetcher each domain uses: 'http' for plain requests, 'selenium' for a full Chrome, and 'auto' (the default for
+# anything not listed) tries plain HTTP first and only escalates to Chrome if the page looks like it needs JavaScript
+# or a bot check turned it away. This is seeded from fetch_modes in the config, and auto detection records the domains
+# it had to escalate for JavaScript
+domain_fetch_modes = {}
+domain_fetch_modes_lock = threading.Lock()
+
+# Markers that show up on pages that are only a shell for JavaScript or a bot check
+javascript_page_markers = [
+    'enable javascript',
+    'javascript is required',
+    'javascript is disabled',
+    'cf-browser-verification',
+    'challenge-platform',
+    'just a moment...',
+]
+
+# Statuses from the plain HTTP fetch that look like a bot check, in auto mode the browser gets a try at these. Anything
+# else is the real answer, a missing page (404) or an expired posting (410) won't be there in Chrome either
+blocked_statuses = {403, 429}
+
+# Each thread keeps its own pooled requests session, sessions aren't guaranteed to be thread safe
+http_local = threading.local()
+
+
+def get_http_session():
+    session = getattr(http_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+
+        # Keep connections open between requests to the same site
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=2)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        # Look like a regular browser and ask for compressed responses
+        session.headers.update({
+            'User-Agent': UserAgent().random,
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Encoding': 'gzip, deflate',
+        })
+        http_local.session = session
+    return session
+
+
+def http_get_raw_page(page_url, timeout=20, debug=False):
+    # Returns the page and the HTTP status, the page is False unless the status is 200. The status is None when the
+    # site didn't answer at all, and 0 when the request couldn't be made (like a bad URL or a redirect loop)
+    if debug:
+        print("http_get_raw_page")
+        time_to_get_page = time.time()
+
+    try:
+        # Connect timeout is kept short so dead sites fail fast, read timeout is the full timeout
+        response = get_http_session().get(page_url, timeout=(5, timeout))
+    except (requests.ConnectionError, requests.Timeout) as e:
+        if debug:
+            print(f"http_get_raw_page - An error occurred: {e}\n\t{page_url}")
+        return False, None
+    except requests.RequestException as e:
+        if debug:
+            print(f"http_get_raw_page - An error occurred: {e}\n\t{page_url}")
+        return False, 0
+
+    if response.status_code != 200:
+        if debug:
+            print(f"http_get_raw_page - Got status {response.status_code}\n\t{page_url}")
+        return False, response.status_code
+
+    # Requests falls back to latin-1 when the server doesn't send a charset, most of these sites are utf-8
+    if 'charset' not in response.headers.get('content-type', '').lower():
+        response.encoding = 'utf-8'
+
+    if debug:
+        cprint(f"Time to get page: {round(time.time()-time_to_get_page, 2)} seconds\n\n","yellow")
+
+    return response.text, response.status_code
+
+
+def site_pushed_back(status):
+    # The site didn't answer, asked us to slow down, or is having trouble. A missing page (404) is the site working
+    # fine, it shouldn't slow down the rest of the site's pages
+    return status is None or status == 429 or status >= 500
+
+
+def page_is_feed(raw_page):
+    # RSS, Atom, and RDF feeds all announce themselves in the first few lines
+    return bool(re.search(r'<(rss|feed|rdf:RDF)[\s>]', raw_page[:2000]))
+
+
+def page_needs_javascript(raw_page):
+    # Feeds are never rendered by JavaScript
+    if page_is_feed(raw_page):
+        return False
+
+    # Look for the telltale messages of JavaScript only pages and bot checks
+    page_text = get_page_body_text(raw_page, True)
+    if page_text == False:
+        return True
+    lower_text = raw_page[:20000].lower()
+    if any(marker in lower_text for marker in javascript_page_markers) and len(page_text) < 1000:
+        return True
+
+    # Same threshold selenium_get_raw_page uses to decide a page has loaded
+    return len(page_text) < 250
+
+
+def absolutize_links(raw_page, page_url):
+    # Convert all relative links to absolute
+    try:
+        document = lxml_html.fromstring(xml_declaration.sub('', raw_page, count=1))
+    except (etree.ParserError, ValueError):
+        return raw_page
+    document.make_links_absolute(page_url, resolve_base_href=True, handle_failures='ignore')
+    return lxml_html.tostring(document, encoding='unicode')
+
+
+# Parsing HTML and extracting text is CPU work that holds the GIL, so with many threads it ends up running one page at
+# a time. With a pool started, it runs in separate processes instead, one page per core, while the threads go back to
+# waiting on browsers and OpenAI. The functions sent to the pool take the raw HTML and return text or links, so only
+# strings go between the processes
+extraction_pool = None
+extraction_pool_lock = threading.Lock()
+
+
+def start_extraction_pool(processes):
+    # Has to be called before any threads start. The processes are forked so they don't import scroop.py again, and
+    # forking is only safe while the program is still on one thread. Where fork isn't available everything stays in
+    # the threads
+    global extraction_pool
+    if processes <= 0 or 'fork' not in multiprocessing.get_all_start_methods():
+        return False
+
+    with extraction_pool_lock:
+        if extraction_pool is None:
+            extraction_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork'))
+
+            # A fork pool starts every process on the first job, get that done now while it's safe
+            extraction_pool.submit(os.getpid).result()
+    return True
+
+
+def stop_extraction_pool():
+    global extraction_pool
+    with extraction_pool_lock:
+        pool, extraction_pool = extraction_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_extraction(func, *args):
+    # Runs func(*args) in the extraction pool, or right here if there's no pool. If a process in the pool dies the
+    # pool can't be restarted safely with the threads running, so the rest of the run extracts in the threads
+    global extraction_pool
+    pool = extraction_pool
+    if pool is not None:
+        try:
+            return pool.submit(func, *args).result()
+        except BrokenProcessPool:
+            cprint("The extraction processes stopped working, extracting in the threads from now on", 'red')
+            with extraction_pool_lock:
+                if extraction_pool is pool:
+                    extraction_pool = None
+    return func(*args)
+
+
+atexit.register(stop_extraction_pool)
+
+
+class DomainScheduler:
+    # Politeness for each site. No more than max_per_domain fetches run against a domain at once, fetches to a domain
+    # start at least min_delay seconds apart, and every time in a row the site pushes back (no answer, too many
+    # requests, or a server error) doubles that delay (up to max_backoff) so it gets left alone for a while
+
+    def __init__(self, max_per_domain=2, min_delay=1.0, max_backoff=60):
+        self.max_per_domain = max_per_domain
+        self.min_delay = min_delay
+        self.max_backoff = max_backoff
+
+        # Fetches running, earliest next start, and push backs in a row, for each domain
+        self.active = {}
+        self.next_start = {}
+        self.failures = {}
+        self.condition = threading.Condition()
+
+    def configure(self, max_per_domain=None, min_delay=None, max_backoff=None):
+        with self.condition:
+            if max_per_domain is not None:
+                self.max_per_domain = max(1, max_per_domain)
+            if min_delay is not None:
+                self.min_delay = min_delay
+            if max_backoff is not None:
+                self.max_backoff = max_backoff
+            self.condition.notify_all()
+
+    def ready_in(self, domain):
+        # Seconds until a fetch to this domain could start, infinity if it's at its limit of fetches
+        with self.condition:
+            if self.active.get(domain, 0) >= self.max_per_domain:
+                return float('inf')
+            return max(0, self.next_start.get(domain, 0) - time.monotonic())
+
+    def acquire(self, domain):
+        with self.condition:
+            while True:
+                wait = self.next_start.get(domain, 0) - time.monotonic()
+                if self.active.get(domain, 0) < self.max_per_domain and wait <= 0:
+                    break
+                self.condition.wait(wait if wait > 0 else None)
+
+            self.active[domain] = self.active.get(domain, 0) + 1
+
+            # Space the next fetch out, backing off further for each recent push back
+            delay = min(self.max_backoff, self.min_delay * 2 ** self.failures.get(domain, 0))
+            self.next_start[domain] = time.monotonic() + delay
+
+    def release(self, domain, backoff=False):
+        with self.condition:
+            self.active[domain] -= 1
+            self.failures[domain] = min(self.failures.get(domain, 0) + 1, 10) if backoff else 0
+            if backoff:
+                # Push the next fetch back by the backoff
+                delay = min(self.max_backoff, self.min_delay * 2 ** self.failures[domain])
+                self.next_start[domain] = max(self.next_start.get(domain, 0), time.monotonic() + delay)
+            self.condition.notify_all()
+
+
+# The one domain scheduler for the whole run, every network fetch goes through it
+domain_scheduler = DomainScheduler()
+
+
+def get_page_content(url, cache_age=72, debug=False, fetch_mode=None):
     
     # Convert cache age to seconds
     cache_age *= 60 * 60
@@ -61,223 +319,595 @@ def get_page_content(driver, url, cache_age=72, debug=False):
         print("get_page_content")
         print(f"cache age set to {cache_age} seconds")
 
-    # Create a directory called 'cached_pages' if it doesn't exist
-    os.makedirs('cached_pages', exist_ok=True)
-
-    # Convert the URL to a filename by hashing it
-    filename = hashlib.md5(url.encode()).hexdigest()
+    domain = urlparse(url).netloc
 
-    # Construct the full file path
-    filepath = os.path.join('cached_pages', filename)
-
-    # If the file exists and is not older than the cache age, return its content
-    if os.path.exists(filepath) and (cache_age < 0 or time.time() - os.path.getmtime(filepath) <= cache_age):
+    # If the page is cached and is not older than the cache age, return its content
+    cached_page = get_cached(url, 'raw_html', cache_age)
+    if cached_page:
         if debug:
-            print(f"cache {filepath} exists and is younger than {cache_age} seconds, using cached data")
-        with open(filepath, 'r') as file:
-            return file.read()
+            print(f"cache for {url} is younger than {cache_age} seconds, using cached data")
+        metrics.count('scroop_page_fetches', domain=domain, cache='hit', result='ok')
+        return cached_page
 
     if debug:
-        print(f"cache {filepath} doesn't exist or is older than {cache_age} seconds, getting fresh data")
+        print(f"cache for {url} doesn't exist or is older than {cache_age} seconds, getting fresh data")
+
+    # Pick the fetcher for this site, unless the caller forced one
+    if fetch_mode is None:
+        fetch_mode = domain_fetch_modes.get(domain, 'auto')
 
-    # Get the raw page content
-    output = selenium_get_raw_page(driver, url, debug)
+    output = False
+    status = None
+
+    # Wait for this site's turn, then try the plain HTTP fetch first, it's a fraction of the cost of a browser
+    with tracer.span('wait for domain', 'fetch', domain=domain):
+        domain_scheduler.acquire(domain)
+    try:
+        with metrics.timer('scroop_page_fetch_seconds', domain=domain, mode=fetch_mode), tracer.span('fetch', 'fetch', url=url, mode=fetch_mode):
+            output, status = fetch_page(url, domain, fetch_mode, debug)
+    finally:
+        # Only back off when the site is pushing back, not for every page that's missing
+        backoff = not output and site_pushed_back(status)
+        domain_scheduler.release(domain, backoff=backoff)
+        metrics.count('scroop_page_fetches', domain=domain, cache='miss', result='ok' if output else 'pushed_back' if backoff else 'error')
 
     #print("we are sleeping the long sleeps seconds since this is a first run it'll get lots and lots of links")
     #time.sleep(60)
 
-    # If the output is not None or empty, save it to a file and return it
+    # If the output is not None or empty, save it to the cache and return it
     if output:
-        with open(filepath, 'w') as file:
-            file.write(str(output))
+        set_cached(url, 'raw_html', str(output))
         if debug:
-            print(f"writing out data for future cache {filepath}")
+            print(f"writing out data for future cache {url}")
         return output
 
     # If the output is None or empty, return False
     return False
 
 
+class Page:
+    # One fetched page. The raw HTML is kept as it is, and the things worked out from it (the main text, the links)
+    # are worked out the first time they're asked for and remembered. They're also saved with the page in the cache,
+    # so they're worked out once per version of the page, not once per stage or per run. The main text is saved
+    # against a hash of the HTML and the extractor version, so a page that's fetched again unchanged keeps it, and a
+    # new version of trafilatura extracts it again
+
+    def __init__(self, url, raw_html):
+        self.url = url
+        self.raw_html = raw_html
+        self.derived = {}
+        self.lock = threading.Lock()
+
+    def derive(self, name, work_out, cache_field=None):
+        with self.lock:
+            if name in self.derived:
+                return self.derived[name]
+
+        # Look for it in the cache before working it out, the cache stores JSON so False and lists survive
+        value = None
+        if cache_field:
+            cached_value = get_cached(self.url, cache_field)
+            if cached_value is not None:
+                value = json.loads(cached_value)
+
+        if value is None:
+            value = work_out()
+            if cache_field:
+                set_cached(self.url, cache_field, json.dumps(value))
+
+        with self.lock:
+            self.derived[name] = value
+        return value
+
+    @property
+    def content_hash(self):
+        return self.derive('content_hash', lambda: content_hash(self.raw_html))
+
+    @property
+    def main_text(self):
+        # The main text of the page from trafilatura, False if there isn't any
+        return self.derive('main_text', self.extract_main_text)
+
+    def extract_main_text(self):
+        cached_text = get_cached_text(self.url, text_extractor_version)
+        if cached_text is not None:
+            return cached_text or False
+
+        # Pages without any text are saved as blank, so they aren't extracted again either
+        with metrics.timer('scroop_extraction_seconds'), tracer.span('extract text', 'extract', url=self.url):
+            text = run_extraction(get_page_body_text, self.raw_html)
+        set_cached_text(self.url, text or '', text_extractor_version, self.content_hash)
+        return text
+
+    @property
+    def links(self):
+        return self.derive('links', self.extract_page_links, 'page_links')
+
+    def extract_page_links(self):
+        with metrics.timer('scroop_link_extraction_seconds'), tracer.span('extract links', 'extract', url=self.url):
+            return run_extraction(extract_links, self.raw_html)
+
+
+def get_page(url, cache_age=72, debug=False, fetch_mode=None):
+    # Same as get_page_content, but returns a Page, or None if the page couldn't be fetched
+    raw_html = get_page_content(url, cache_age, debug, fetch_mode)
+    if not raw_html:
+        return None
+    return Page(url, raw_html)
+
 
-def extract_links(page_content: str, debug: bool = False) -> list:
+def get_page_text(url, cache_age=72, debug=False):
+    # The main text of the page. When the text of the cached HTML has already been extracted it comes straight
+    # from the cache, without loading or parsing the HTML
+    cached_text = get_cached_text(url, text_extractor_version, cache_age * 60 * 60)
+    if cached_text is not None:
+        metrics.count('scroop_page_fetches', domain=urlparse(url).netloc, cache='text', result='ok')
+        return cached_text or False
 
-    # Parse the HTML content with Beautiful Soup
-    soup = BeautifulSoup(page_content, 'html.parser')
+    page = get_page(url, cache_age, debug)
+    return page.main_text if page else False
 
-    # Use a list comprehension to extract all href attributes from 'a' tags
-    # The 'if href' condition filters out any 'None' values
-    urls = [a_tag.get('href') for a_tag in soup.find_all('a') if (href := a_tag.get('href'))]
 
-    # Print the number of links found if debug mode is on
-    if debug:
-        print(f"Found {len(urls)} href links")
+def fetch_page(url, domain, fetch_mode, debug=False):
+    # Returns the page (False if it couldn't be fetched) and the HTTP status. The browser doesn't report a status, a
+    # page it loads counts as 200 and one it fails on counts as no answer
+    output = False
+    status = None
+    use_browser = fetch_mode == 'selenium'
 
-    # Unescape HTML entities
-    page_content = re.sub('&amp;', '&', page_content)
+    # Try the plain HTTP fetch first, it's a fraction of the cost of a browser
+    if fetch_mode in ('http', 'auto'):
+        with tracer.span('http get', 'fetch', url=url):
+            output, status = http_get_raw_page(url, debug=debug)
 
-    # Remove linebreaks and existing tildes
-    page_content = re.sub('\n|~', ' ', page_content)
+        if output and not page_is_feed(output):
+            output = run_extraction(absolutize_links, output, url)
 
-    # Add a newline and a tilde before each opening link tag and a newline after each closing link tag
-    page_content = re.sub('<link>', '\n~<link>', page_content)
-    page_content = re.sub('</link>', '</link>\n', page_content)
+        if fetch_mode == 'auto':
+            # If the page only works with JavaScript, remember that for the rest of the site and use the browser
+            if output and run_extraction(page_needs_javascript, output):
+                if debug:
+                    print(f"{domain} needs a browser, switching to selenium")
+                with domain_fetch_modes_lock:
+                    domain_fetch_modes[domain] = 'selenium'
+                output = False
+                use_browser = True
 
-    # Remove all the HTML tags
-    soup = BeautifulSoup(page_content, 'html.parser')
-    page_content = soup.get_text()
+            # A bot check might let a real browser through, just for this page
+            elif status in blocked_statuses:
+                if debug:
+                    print(f"{url} was blocked with status {status}, trying selenium")
+                use_browser = True
 
-    # Remove leading whitespace, lines that don't start with a tilde, lines that are only a single character, and extra newlines
-    page_content = re.sub('^\s+|^[^~].+|^.$|\n+', '', page_content)
+    if use_browser:
+        # Borrow a browser from the shared pool just for this page
+        with browser_pool.browser() as driver:
+            # Get the raw page content
+            output = selenium_get_raw_page(driver, url, debug)
+        status = 200 if output else None
 
-    # Remove the tildes
-    page_content = re.sub('~', '', page_content)
+    return output, status
 
-    # Split the page content into lines and strip any whitespace
-    lines = [line.strip() for line in page_content.split('\n')]
 
-    # Use a list comprehension to parse each line as a URL and add it to the list if it's a valid URL
-    urls += [line for line in lines if urlparse(line).scheme and urlparse(line).netloc]
 
-    # Print the number of link tags found if debug mode is on
-    if debug:
-        print(f"Found {len(urls) - len(lines)} link tags")
+# lxml won't parse a str that still has its <?xml encoding="..."?> declaration, the text is already decoded anyway
+xml_declaration = re.compile(r'^\s*<\?xml[^>]*\?>')
 
-    # Return the list of URLs
+# Text in a <link> tag is only a link if it looks like a URL
+link_text_url = re.compile(r'^https?://\S+$')
+
+# recover keeps going past the broken markup that's common in job feeds, and entities are never fetched
+feed_parser = etree.XMLParser(recover=True, huge_tree=True, resolve_entities=False, no_network=True)
+
+
+def extract_feed_links(page_content):
+    root = etree.fromstring(xml_declaration.sub('', page_content, count=1), feed_parser)
+    if root is None:
+        return None
+
+    urls = []
+    for element in root.iter():
+        # Skip comments and processing instructions, and ignore namespaces on the tag
+        if not isinstance(element.tag, str) or etree.QName(element).localname != 'link':
+            continue
+
+        # RSS puts the URL inside the tag, Atom puts it in href
+        url = (element.text or '').strip() or element.get('href', '').strip()
+        if link_text_url.match(url):
+            urls.append(url)
     return urls
 
 
+def extract_html_links(page_content):
+    try:
+        document = lxml_html.fromstring(xml_declaration.sub('', page_content, count=1))
+    except (etree.ParserError, ValueError):
+        return []
+
+    urls = []
+    for element in document.iter('a', 'link'):
+        if element.tag == 'a':
+            # Extract all href attributes from 'a' tags, skipping empty ones
+            if href := element.get('href'):
+                urls.append(href)
+        else:
+            # Feeds that went through an HTML parser (like pages from the browser) have their <link> URLs left as
+            # text after the tag, since <link> can't have contents in HTML
+            url = (element.text or element.tail or '').strip()
+            if link_text_url.match(url):
+                urls.append(url)
+    return urls
+
+
+def extract_links(page_content: str, debug: bool = False) -> list:
+    if not page_content:
+        return []
+
+    # Feeds are read as XML, everything else as HTML, either way it's one parse and one walk through the document
+    urls = None
+    if page_is_feed(page_content):
+        urls = extract_feed_links(page_content)
+        if debug:
+            print(f"Found {len(urls or [])} feed links")
+
+    # Pages that only look like feeds are read as HTML
+    if urls is None:
+        urls = extract_html_links(page_content)
+        if debug:
+            print(f"Found {len(urls)} href and link tag links")
+
+    # Return the list of URLs
+    return urls
 
 
 def link_cleaner(links, search_sites, debug=False):
     if debug:
         print("link_cleaner")
 
-    extensions = ['js', 'jpg', 'jpeg', 'png', 'gif', 'html', 'css', 'svg', 'pdf', 'mp4', 'mp3', 'json', 'xml', 'ico', 'webp' ]
+    extensions = tuple('.' + ext for ext in ['js', 'jpg', 'jpeg', 'png', 'gif', 'html', 'css', 'svg', 'pdf', 'mp4', 'mp3', 'json', 'xml', 'ico', 'webp' ])
 
-    # Extract the domain from each search site using the urlparse function
-    search_domains = {urlparse(site).netloc for site in search_sites}
+    # Extract the domain from each search site
+    search_domains = {urlsplit(site).netloc for site in search_sites}
 
-    # Initialize an empty list to store the clean links
-    clean_links = []
+    # The clean links, a dict keeps them in order while removing duplicates
+    clean_links = {}
 
     # Loop over each link in the list of links
     for url in links:
 
-        url = url.strip()
-
-        url = url.replace('http://', 'https://')
-
-        # The link is a tuple, and the actual URL is the first element
-        #url = link[0]
+        url = url.strip().replace('http://', 'https://')
+        lower_url = url.lower()
 
         # Skip links that contain 'keywords='
-        if 'keywords=' in url.lower() or 'academiccareers.com/ajax' in url.lower():
+        if 'keywords=' in lower_url or 'academiccareers.com/ajax' in lower_url:
             continue
 
         # Skip links that end with one of the extensions
-        skip_link = False
-        for ext in extensions:
-            if url.endswith('.' + ext):
-                skip_link = True
-                break
-        if skip_link:
+        if url.endswith(extensions):
             continue
 
         # Handle LinkedIn links that are forwarders
-        if 'externalApply'.lower() in url.lower():
+        if 'externalapply' in lower_url and '?url=' in url:
             # Extract the actual URL from the forwarder
             url = unquote(url.split("?url=")[1].split("&urlHash=")[0])
 
-        # Remove GET arguments from the URL
-        url = urlunparse(urlparse(url)._replace(query="", fragment=""))
+        # Parse the URL once, for both the domain check and removing the GET arguments
+        parts = urlsplit(url)
 
         # Skip links that have a domain that doesn't match the search sites
-        if urlparse(url).netloc not in search_domains:
+        if parts.netloc not in search_domains:
             continue
 
-        # Add the cleaned link to the list
-        clean_links.append(url)
-
-    # Remove duplicates and return the cleaned list of links
-    return list(set(clean_links))
+        # Add the link without its GET arguments to the clean links
+        clean_links[urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))] = True
+
+    # Return the cleaned list of links
+    return list(clean_links)
+
+
+# With word_boundaries on, words only match whole words, so searching for "book" doesn't match "facebook"
+keyword_settings = {
+    'word_boundaries': False,
+}
+
+
+class KeywordMatcher:
+    # The search words, must have words, and anti keywords compiled into one regex, so each page is scanned once no
+    # matter how many words there are. Words in double quotes are phrases, their words have to appear in order but
+    # any whitespace (including line breaks) can come between them
+
+    def __init__(self, search_words, must_have_words, anti_kewords, word_boundaries=False):
+        self.word_lists = {
+            'search': [self.normalize(word) for word in search_words],
+            'must_have': [self.normalize(word) for word in must_have_words],
+            'anti': [self.normalize(word) for word in anti_kewords],
+        }
+
+        # Every distinct word, and which lists it belongs to
+        self.word_kinds = {}
+        for kind, words in self.word_lists.items():
+            for word in words:
+                if word:
+                    self.word_kinds.setdefault(word, set()).add(kind)
+
+        # Longest words first, so a phrase wins over a word it starts with. The pattern is a lookahead, so it's tried at
+        # every position in the page and words that overlap are all found, like "react" and "active" in "reactive"
+        words = sorted(self.word_kinds, key=len, reverse=True)
+        patterns = {word: self.word_pattern(word, word_boundaries) for word in words}
+        self.regex = re.compile('(?=(' + '|'.join(patterns[word] for word in words) + '))', re.IGNORECASE) if words else None
+
+        # Only the longest word starting at each position is matched, so work out up front which shorter words are found
+        # inside each longer one
+        self.implied_words = {
+            word: [other for other in words if other != word and re.search(patterns[other], word)]
+            for word in words
+        }
+
+    @staticmethod
+    def normalize(word):
+        # Remove the double quotes, lowercase, and collapse the whitespace
+        return ' '.join(word.replace('"', '').lower().split())
+
+    @staticmethod
+    def word_pattern(word, word_boundaries):
+        pattern = r'\s+'.join(re.escape(part) for part in word.split(' '))
+        if word_boundaries:
+            pattern = rf'(?<!\w){pattern}(?!\w)'
+        return pattern
+
+    def match(self, page_content):
+        # Returns the words that were found, for each list
+        found = {kind: set() for kind in self.word_lists}
+        if self.regex is None:
+            return found
+
+        seen = set()
+        for match in self.regex.finditer(page_content):
+            word = ' '.join(match.group(1).lower().split())
+            if word in seen:
+                continue
+            for found_word in [word] + self.implied_words.get(word, []):
+                seen.add(found_word)
+                for kind in self.word_kinds[found_word]:
+                    found[kind].add(found_word)
+        return found
 
 
-def find_keywords(page_content, search_words, must_have_words, anti_kewords, debug=False):
-    # Convert the page content to lowercase once, to avoid doing it for each word
-    page_content = page_content.lower()
+@lru_cache(maxsize=8)
+def get_keyword_matcher(search_words, must_have_words, anti_kewords, word_boundaries):
+    # Compiled once per run and shared by every thread, the arguments are tuples so they can be cached on
+    return KeywordMatcher(search_words, must_have_words, anti_kewords, word_boundaries)
 
-    removal_words = [] # maybe words like "facebook"
 
-    # Remove the removal words from the page content.
-    # In case there are collsions between parts of the searchwords, ie searching for "book" but the page contains "facebook"
-    for word in removal_words:
-        page_content = page_content.replace(word.lower(), "")
+def find_keyword_matches(page_content, search_words, must_have_words, anti_kewords):
+    matcher = get_keyword_matcher(tuple(search_words), tuple(must_have_words), tuple(anti_kewords), keyword_settings['word_boundaries'])
+    return matcher.match(page_content)
 
 
-    keyword_found_match = False
-    # Loop through each word in the search words
-    for word in search_words:
-        # Remove the double quotes from the search word and convert it to lowercase
-        word = word.replace('"', '').lower()
+def find_keywords(page_content, search_words, must_have_words, anti_kewords, debug=False):
+    # Scan the page once for every word
+    with tracer.span('find keywords', 'keywords'):
+        matches = find_keyword_matches(page_content, search_words, must_have_words, anti_kewords)
 
-        # Check if the search word appears in the page content
-        if word in page_content:
-            # If the search word is found, and debug mode is on, print a message
-            if debug:
-                print(f"\tFound search word '{word}' in page content")
-            keyword_found_match = True
-            break
+    keyword_found_match = len(matches['search']) > 0
+    if debug and keyword_found_match:
+        print(f"\tFound search words {sorted(matches['search'])} in page content")
 
     # Check if there are any must-have words
     if len(must_have_words) > 0:
         if debug:
             print(f"Must have words: {must_have_words}")
-        # Initialize a counter for the must-have words found in the page content
-        must_have_words_match = 0
-        # Loop through each word in the must-have words
-        for word in must_have_words:
-            # Check if the must-have word appears in the page content
-            if word in page_content:
-                # If the must-have word is found, increment the counter
-                must_have_words_match += 1
+        must_have_words_match = len(matches['must_have'])
         if debug:
-            print(f"Must have words match: {must_have_words_match} of {len(must_have_words)}")
+            print(f"Must have words match: {must_have_words_match} of {len(set(must_have_words))}")
         # If not all must-have words are found in the page content, return False
-        if must_have_words_match < len(must_have_words):
+        if must_have_words_match < len({KeywordMatcher.normalize(word) for word in must_have_words}):
             return False
         # If all must-have words are found and the keyword is found, return True
-        elif must_have_words_match == len(must_have_words) and keyword_found_match == True:
+        elif keyword_found_match == True:
             return True
         
     #if we find any anti-words, we should return false
-    if len(anti_kewords):
-        for word in anti_kewords:
-            if word in page_content:
-                return False
+    if matches['anti']:
+        if debug:
+            print(f"\tFound anti keywords {sorted(matches['anti'])} in page content")
+        return False
 
     # If there are no must-have words, return True if the keyword is found, False otherwise
     return keyword_found_match
 
 
-def gpt_me(prompt, model, key, debug=False):
+# Settings for the OpenAI client. base_url can point at any OpenAI compatible server, like a local mock for testing.
+# Failed requests are retried up to max_retries times, waiting longer each time
+openai_settings = {
+    'base_url': None,
+    'max_retries': 5,
+}
+
+# Counters for the OpenAI requests made this run, printed at the end
+llm_stats = {
+    'requests': 0,
+    'retries': 0,
+    'rate_limited': 0,
+    'errors': 0,
+    'throttle_seconds': 0.0,
+    'prompt_tokens': 0,
+    'completion_tokens': 0,
+    'cache_hits': 0,
+    'cache_misses': 0,
+    'tokens_trimmed': 0,
+}
+llm_stats_lock = threading.Lock()
+
+
+def count_llm_stat(name, amount=1):
+    with llm_stats_lock:
+        llm_stats[name] += amount
+    metrics.count(f'scroop_llm_{name}', amount)
+
+
+class RateLimiter:
+    # Token buckets for the requests per minute and tokens per minute limits on the OpenAI account. acquire waits
+    # until both buckets have room, so the threads slow down before OpenAI starts refusing requests, and a 429
+    # pauses every thread until the time the server asked for
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000):
+        self.lock = threading.Lock()
+        self.configure(requests_per_minute, tokens_per_minute)
+
+    def configure(self, requests_per_minute, tokens_per_minute):
+        with self.lock:
+            self.requests_per_minute = requests_per_minute
+            self.tokens_per_minute = tokens_per_minute
+
+            # Start with full buckets
+            self.request_allowance = requests_per_minute
+            self.token_allowance = tokens_per_minute
+            self.updated = time.monotonic()
+            self.paused_until = 0
+
+    def refill(self, now):
+        # Top the buckets up for the time that's gone by
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_allowance = min(self.requests_per_minute, self.request_allowance + elapsed * self.requests_per_minute / 60)
+        self.token_allowance = min(self.tokens_per_minute, self.token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens):
+        # Returns how long it had to wait
+        waited = 0.0
+
+        # A request bigger than the whole bucket waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.request_allowance >= 1 and self.token_allowance >= tokens:
+                        self.request_allowance -= 1
+                        self.token_allowance -= tokens
+                        return waited
+
+                    # Wait for whichever bucket is further from having room
+                    wait = max(
+                        (1 - self.request_allowance) * 60 / self.requests_per_minute,
+                        (tokens - self.token_allowance) * 60 / self.tokens_per_minute,
+                        0.05,
+                    )
+
+            time.sleep(wait)
+            waited += wait
+
+    def correct(self, estimated_tokens, actual_tokens):
+        # Requests are let through on an estimate, settle up once the real token count is known
+        with self.lock:
+            self.token_allowance -= actual_tokens - estimated_tokens
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# One rate limiter for the whole run, sized from the config
+openai_rate_limiter = RateLimiter()
+
+# One client per API key for the whole run, so connections are kept open and reused between requests
+openai_clients = {}
+openai_clients_lock = threading.Lock()
+
+
+def get_openai_client(key):
+    with openai_clients_lock:
+        client = openai_clients.get((key, openai_settings['base_url']))
+        if client is None:
+            # Retries are handled in gpt_me, so they can go through the rate limiter
+            client = OpenAI(api_key=key, base_url=openai_settings['base_url'], max_retries=0)
+            openai_clients[(key, openai_settings['base_url'])] = client
+    return client
+
+
+def get_retry_after(error):
+    # OpenAI says how long to back off in the retry-after headers of a 429
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+def gpt_me(prompt, model, key, debug=False, response_format=None):
     # If debug mode is on, print the function name
     if debug:
         cprint("gpt_me", "yellow")
 
-    try:
-        # Initialize the OpenAI client with the provided API key
-        client = OpenAI(api_key=key)
-
-        # Create a chat completion with the OpenAI API using the provided prompt and model
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            model=model,
-        )
+    # Roughly four characters per token, plus room for the reply
+    estimated_tokens = len(prompt) // 4 + 500
+
+    # Only ask for a particular format (like JSON) when the caller wants one
+    extra_arguments = {'response_format': response_format} if response_format else {}
+
+    for attempt in range(openai_settings['max_retries'] + 1):
+        if attempt:
+            count_llm_stat('retries')
+
+        # Wait for room under the rate limits
+        with tracer.span('wait for rate limit', 'llm'):
+            count_llm_stat('throttle_seconds', openai_rate_limiter.acquire(estimated_tokens))
+
+        try:
+            # Create a chat completion with the OpenAI API using the provided prompt and model, timing how long each
+            # request takes, labelled by the error if it fails
+            count_llm_stat('requests')
+            started = time.perf_counter()
+            try:
+                with tracer.span('openai request', 'llm', model=model, attempt=attempt):
+                    chat_completion = get_openai_client(key).chat.completions.create(
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": prompt,
+                            }
+                        ],
+                        model=model,
+                        **extra_arguments,
+                    )
+            except Exception as e:
+                metrics.observe('scroop_llm_request_seconds', time.perf_counter() - started, model=model, result=type(e).__name__)
+                raise
+            metrics.observe('scroop_llm_request_seconds', time.perf_counter() - started, model=model, result='ok')
+        except RateLimitError as e:
+            # Everyone waits as long as the server asked, or backs off if it didn't say
+            count_llm_stat('rate_limited')
+            wait = get_retry_after(e) or min(60, 2 ** attempt + random.random())
+            if debug:
+                print(f"Rate limited, waiting {round(wait, 2)} seconds")
+            openai_rate_limiter.pause(wait)
+            continue
+        except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+            # Temporary problems on OpenAI's end or the network, back off and try again
+            if debug:
+                print(f"A temporary ChatGPT error occurred, retrying: {e}")
+            time.sleep(min(60, 2 ** attempt + random.random()))
+            continue
+        except Exception as e:
+            # If an error occurs, print the error and return False
+            count_llm_stat('errors')
+            print(f"A ChatGPT error occurred: {e}\n\t{prompt}\n\n\n\n")
+            return False
+
+        # Keep track of the tokens used, and settle up with the rate limiter
+        if chat_completion.usage:
+            count_llm_stat('prompt_tokens', chat_completion.usage.prompt_tokens)
+            count_llm_stat('completion_tokens', chat_completion.usage.completion_tokens)
+            openai_rate_limiter.correct(estimated_tokens, chat_completion.usage.total_tokens)
 
         # If debug mode is on, print the first 250 characters of the response
         if debug:
@@ -285,10 +915,11 @@ def gpt_me(prompt, model, key, debug=False):
 
         # Return the full response
         return chat_completion.choices[0].message.content
-    except Exception as e:
-        # If an error occurs, print the error and return an empty string
-        print(f"A ChatGPT error occurred: {e}\n\t{prompt}\n\n\n\n")
-        return False
+
+    # Out of retries
+    count_llm_stat('errors')
+    print(f"A ChatGPT error occurred: gave up after {openai_settings['max_retries'] + 1} attempts\n\t{prompt[:500]}\n\n\n\n")
+    return False
 
 def gpt_true_or_false(prompt, model, open_ai_key, retries=3, debug=False):
     if debug:
@@ -304,6 +935,10 @@ def gpt_true_or_false(prompt, model, open_ai_key, retries=3, debug=False):
         # Send the prompt to the Ollama API and get a response
         job_info = gpt_me(prompt, model, open_ai_key, debug)
 
+        # gpt_me has already retried errors, so if it failed there's no point asking again
+        if job_info == False:
+            return None
+
         # Return True if the response contains "true", False if it contains "false"
         job_info_lower = job_info.lower()
         if "true" in job_info_lower:
@@ -318,9 +953,6 @@ def gpt_true_or_false(prompt, model, open_ai_key, retries=3, debug=False):
                 print(f"gpt reply: {job_info[:500]}")
                 print("\tRetrying, didn't get True or False...")
 
-        # Sleep for a progressively longer time with each retry
-        time.sleep(5 * i)
-
     # If it's tried 'retries' times and still hasn't gotten a clear "true" or "false", return None
     return None
 
@@ -338,6 +970,10 @@ def gpt_range(prompt, model, open_ai_key, retries=3, debug=False):
         # Send the prompt to the Ollama API and get a response
         job_info = gpt_me(prompt, model, open_ai_key, debug)
 
+        # gpt_me has already retried errors, so if it failed there's no point asking again
+        if job_info == False:
+            return None
+
         # Remove all non-digit characters from the response and convert it to an integer
         job_info = re.sub(r'\D', '', job_info)
         job_info = int(job_info) if job_info else None
@@ -347,7 +983,7 @@ def gpt_range(prompt, model, open_ai_key, retries=3, debug=False):
             print(f"gpt reply: {job_info}")
 
         # If the response is a number between 1 and 10, return it
-        if 1 <= job_info <= 10:
+        if job_info is not None and 1 <= job_info <= 10:
             return job_info
         else:
             # If the response isn't a number between 1 and 10, print a message saying it's retrying,
@@ -355,9 +991,6 @@ def gpt_range(prompt, model, open_ai_key, retries=3, debug=False):
             if debug:
                 print("\tRetrying, didn't get a number between 1 and 10...")
 
-        # Sleep for a progressively longer time with each retry
-        time.sleep(5 * i)
-
     # If it's tried 'retries' times and still hasn't gotten a number between 1 and 10, return None
     return None
 
@@ -385,10 +1018,243 @@ def initialize_selenium_browser(debug=False):
         chrome_options.add_argument("--headless")  # Run in headless mode if not in debug mode
 
     # Create a WebDriver object
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
+    driver = webdriver.Chrome(service=Service(get_chromedriver_path()), options=chrome_options)
 
     return driver
 
+
+# ChromeDriverManager checks for (and possibly downloads) a driver every time it's called, so only do it once per run
+chromedriver_path = None
+chromedriver_lock = threading.Lock()
+
+
+def get_chromedriver_path():
+    global chromedriver_path
+    with chromedriver_lock:
+        if chromedriver_path is None:
+            chromedriver_path = ChromeDriverManager().install()
+    return chromedriver_path
+
+
+class BrowserPool:
+    # A bounded set of Chrome browsers shared by every thread and every stage. A browser is checked out for one
+    # page and returned afterwards, checked for health before it's reused, and replaced after max_pages pages
+    # so Chrome's memory use doesn't creep up over a long run
+
+    def __init__(self, size=8, max_pages=50, debug=False):
+        self.size = size
+        self.max_pages = max_pages
+        self.debug = debug
+
+        # Browsers waiting to be used, and how many pages each browser has loaded
+        self.idle = []
+        self.page_counts = {}
+
+        # Number of browsers that exist right now, idle or checked out
+        self.started = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def configure(self, size=None, max_pages=None, debug=None):
+        with self.condition:
+            if size is not None:
+                self.size = max(1, size)
+            if max_pages is not None:
+                self.max_pages = max_pages
+            if debug is not None:
+                self.debug = debug
+            self.condition.notify_all()
+
+    def checkout(self):
+        while True:
+            driver = None
+            with self.condition:
+                # Wait for an idle browser, or for room to start a new one
+                while not self.idle and self.started >= self.size and not self.closed:
+                    self.condition.wait()
+
+                if self.closed:
+                    raise RuntimeError("The browser pool has been shut down")
+
+                if self.idle:
+                    driver = self.idle.pop()
+                else:
+                    self.started += 1
+
+            if driver is None:
+                # Start the browser outside the lock, it takes a few seconds
+                try:
+                    with tracer.span('start chrome', 'browser'):
+                        driver = initialize_selenium_browser(self.debug)
+                except Exception:
+                    with self.condition:
+                        self.started -= 1
+                        self.condition.notify()
+                    raise
+                with self.condition:
+                    self.page_counts[driver] = 0
+                return driver
+
+            # Only hand out browsers that still respond, otherwise throw it away and try again
+            if self.is_healthy(driver):
+                return driver
+            if self.debug:
+                print("Browser failed its health check, replacing it")
+            self.discard(driver)
+
+    def checkin(self, driver, broken=False):
+        with self.condition:
+            self.page_counts[driver] = self.page_counts.get(driver, 0) + 1
+            retire = broken or self.closed or self.page_counts[driver] >= self.max_pages or self.started > self.size
+            if not retire:
+                self.idle.append(driver)
+                self.condition.notify()
+        if retire:
+            self.discard(driver)
+
+    def discard(self, driver):
+        with self.condition:
+            self.page_counts.pop(driver, None)
+            self.started -= 1
+            self.condition.notify()
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @staticmethod
+    def is_healthy(driver):
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+
+    @contextmanager
+    def browser(self):
+        with tracer.span('browser checkout', 'browser'):
+            driver = self.checkout()
+        try:
+            yield driver
+        except Exception:
+            self.checkin(driver, broken=True)
+            raise
+        self.checkin(driver)
+
+    def shutdown(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.condition.notify_all()
+
+        # Browsers that are still checked out get quit when they're returned
+        for driver in idle:
+            self.discard(driver)
+
+
+# The one browser pool for the whole run, quit everything when the program exits no matter how it exits
+browser_pool = BrowserPool()
+atexit.register(browser_pool.shutdown)
+
+# How long to wait for a page in the browser. The page is ready once its DOM has stopped changing for stable_for
+# seconds (or a readiness selector for the site shows up), and is given up on after timeout seconds
+page_wait_settings = {
+    'timeout': 15,
+    'stable_for': 0.75,
+    'poll_interval': 0.25,
+}
+
+# CSS selectors that mean a site's page is ready, keyed by domain, seeded from readiness_selectors in the config
+domain_readiness_selectors = {}
+
+# How long each domain typically takes to be ready, learned as pages load. Polling doesn't start until about half
+# that time has gone by, since the page can't be ready yet
+domain_load_times = {}
+domain_load_times_lock = threading.Lock()
+
+# Counts DOM changes with a MutationObserver (installed on the first call for each page), and reports the counter,
+# the size of the page and its text, and whether the readiness selector has shown up. Pages that were marked as the
+# previous page before navigating report themselves as such, so a reused browser never mistakes the old page for the new one
+page_state_script = """
+var state = {ready: document.readyState, mutations: -1, length: 0, text: 0, selector: false};
+if (window.__scroopPreviousPage) {
+    state.ready = 'previous';
+} else if (document.documentElement) {
+    if (window.__scroopMutations === undefined) {
+        window.__scroopMutations = 0;
+        new MutationObserver(function (records) { window.__scroopMutations += records.length; })
+            .observe(document.documentElement, {childList: true, subtree: true, characterData: true});
+    }
+    state.mutations = window.__scroopMutations;
+    state.length = document.documentElement.innerHTML.length;
+    state.text = document.body ? document.body.innerText.length : 0;
+    if (arguments[0]) {
+        state.selector = document.querySelector(arguments[0]) !== null;
+    }
+}
+return state;
+"""
+
+
+def wait_for_page_ready(driver, page_url, debug=False):
+    domain = urlparse(page_url).netloc
+    selector = domain_readiness_selectors.get(domain)
+    timeout = page_wait_settings['timeout']
+    stable_for = page_wait_settings['stable_for']
+
+    start = time.time()
+
+    # Skip the polls that can't succeed, based on how long this site usually takes
+    typical_load_time = domain_load_times.get(domain)
+    if typical_load_time:
+        time.sleep(min(typical_load_time / 2, timeout / 2))
+
+    last_fingerprint = None
+    stable_since = time.time()
+    while time.time() - start < timeout:
+        try:
+            state = driver.execute_script(page_state_script, selector)
+        except Exception:
+            # The script can fail while the browser is still switching documents
+            state = None
+
+        now = time.time()
+        if state and state['ready'] != 'previous':
+            # The readiness selector is the strongest signal, when the site has one
+            if selector and state['selector']:
+                break
+
+            # Reset the stability timer whenever the DOM changes
+            fingerprint = (state['mutations'], state['length'])
+            if fingerprint != last_fingerprint:
+                last_fingerprint = fingerprint
+                stable_since = now
+            stable_time = now - stable_since
+
+            # Without a selector, the page is ready once it has a reasonable amount of text and has stopped changing.
+            # Pages that stay short are accepted after they've been still for a good while longer
+            if not selector and state['ready'] != 'loading':
+                if (state['text'] >= 250 and stable_time >= stable_for) or stable_time >= stable_for * 4:
+                    break
+
+        time.sleep(page_wait_settings['poll_interval'])
+    else:
+        if debug:
+            print(f"Timed out waiting for {page_url}")
+        return False
+
+    # Keep a running average of how long this site takes
+    load_time = time.time() - start
+    with domain_load_times_lock:
+        previous = domain_load_times.get(domain)
+        domain_load_times[domain] = load_time if previous is None else previous * 0.7 + load_time * 0.3
+
+    if debug:
+        print(f"Page ready after {round(load_time, 2)} seconds")
+
+    return True
+
+
 def selenium_get_raw_page(driver, page_url, debug=False):
     # If debug mode is on, print a message
     if debug:
@@ -396,41 +1262,31 @@ def selenium_get_raw_page(driver, page_url, debug=False):
         time_to_get_page = time.time()
 
     try:
-        # Navigate to the page
-        driver.get(url=page_url)
-
-        # Wait for the page to load
-        time.sleep(5)
-
- 
-        for _ in range(5):
-            if debug:
-                print("scrolling down")
-            # Add some random mouse movements
-            action = ActionChains(driver)
-            action.move_by_offset(random.randint(1, 10), random.randint(1, 10))
-            action.perform()
+        # Mark whatever the browser is showing now, so the wait below doesn't mistake it for the new page
+        driver.execute_script("window.__scroopPreviousPage = true;")
 
-            # Get the page content
-            page_content = get_page_body_text(driver.page_source,True,False)
+        # Navigate to the page
+        with tracer.span('browser get', 'browser', url=page_url):
+            driver.get(url=page_url)
 
-            # If the page content is not found or is too short, wait and try again
-            if page_content == False:
-                continue
-            elif len(page_content)>=250:
-                break
+        # Wait until the page has rendered, rather than a fixed amount of time
+        with tracer.span('wait for page ready', 'browser', url=page_url):
+            page_ready = wait_for_page_ready(driver, page_url, debug)
+        if debug and not page_ready:
+            print(f"Page never looked ready, using what loaded in {page_wait_settings['timeout']} seconds")
 
-            time.sleep(1)
+        # Add some random mouse movements
+        action = ActionChains(driver)
+        action.move_by_offset(random.randint(1, 10), random.randint(1, 10))
+        action.perform()
 
         # Convert all relative links to absolute
-        soup = BeautifulSoup(driver.page_source, 'html.parser')
-        for a in soup.find_all('a', href=True):
-            a['href'] = urljoin(page_url, a['href'])
+        page_source = run_extraction(absolutize_links, driver.page_source, page_url)
 
         # Return the page source
         if debug:
             cprint(f"Time to get page: {round(time.time()-time_to_get_page)} seconds\n\n","yellow")
-        return str(soup)
+        return page_source
     except Exception as e:
         # If an error occurs, print the error and return False
         print(f"selenium_get_raw_page - An error occurred: {e}\n\t{page_url}")
@@ -438,94 +1294,338 @@ def selenium_get_raw_page(driver, page_url, debug=False):
             cprint(f"Time to fail to get page: {round(time.time()-time_to_get_page)} seconds\n\n","yellow")
         return False
 
-def get_search_links(urls, search_sites, debug=False):
-    # Initialize an empty list to store all the links
-    all_links = []
+def get_search_page_links(url, search_sites, debug=False):
+    if debug:
+        cprint("get_search_page_links","yellow")
+        print(f"\t{url}")
 
-    driver = initialize_selenium_browser(debug)
+    # Fetch the page content
+    if debug:
+        print(f"Fetching page content")
 
-    for url in urls:
-        if debug:
-            cprint("get_search_links","yellow")
-            print(f"\t{url}")
+    if debug:
+        page = get_page(url, 0, False)  # for debug disable cache
+    else:
+        page = get_page(url, 2, False)  # 2 hours
+    
+    if debug:
+        print(f"Got page content")
+        if page:
+            print(f"Length of 'page_content': {len(page.raw_html)}")
 
-        # Fetch the page content
-        if debug:
-            print(f"Fetching page content")
+    # If the page content wasn't fetched there are no links
+    if not page:
+        return []
 
+    # Extract the links from the page content
+    if debug:
+        print(f"Extracting links")
+    fresh_links = page.links
+    if debug:
+        print(f"Extracted {len(fresh_links)} links")
+
+    # Clean the extracted links by making sure they contain the search site URL and removing duplicates
+    fresh_links = link_cleaner(fresh_links, search_sites)
+    if debug:
+        print(f"Cleaned {len(fresh_links)} links")
+
+    return fresh_links
+
+
+def process_link(link, search_words, must_have_words, anti_kewords):
+    # Fetch the page content and cache it for 30 days (720 hours = 30 days), and extract the body text from it
+    page_content = get_page_text(link, 720)
+
+    # If there is body text
+    if page_content:
+        # Check if any of the search words are in the body text
+        found_word = find_keywords(page_content, search_words, must_have_words, anti_kewords)
+
+        # If a search word was not found
+        if not found_word:
+            # Record the link so it's skipped in future runs
+            mark_seen(link, 'filtered')
+            metrics.count('scroop_keyword_checks', result='filtered')
+
+            return False
+
+        metrics.count('scroop_keyword_checks', result='passed')
+        return True
+
+    # Pages without any text are kept, they're reported as errors later and tried again next run
+    metrics.count('scroop_keyword_checks', result='no_text')
+    return True
+
+
+# Words too common to say anything about whether a job fits
+relevance_stopwords = set('''
+a about above after all also an and any are as at be been being both but by can could did do does each for from had
+has have he her his how i if in into is it its job jobs may more most must my no not of on or our out over own per
+she should so some such than that the their them then there these they this those through to under up us very was
+we were what when where which while who will with within would you your
+'''.split())
+
+
+def relevance_tokens(text):
+    # Lowercase words, keeping the symbols in names like c++, c#, and node.js
+    return [word.strip('.') for word in re.findall(r'[a-z0-9][a-z0-9+#.]*', text.lower()) if word.strip('.') not in relevance_stopwords]
+
+
+def bm25_scores(query, documents, k1=1.5, b=0.75):
+    # Okapi BM25 for each document against the query, with the word weights (IDF) worked out across all the documents
+    # together, so words every job mentions count for little and the words that set a job apart count for a lot
+    document_counts = [Counter(relevance_tokens(document)) for document in documents]
+    if not document_counts:
+        return []
+
+    document_lengths = [sum(counts.values()) for counts in document_counts]
+    average_length = sum(document_lengths) / len(document_lengths) or 1
+
+    # How many documents each word is in
+    document_frequency = Counter()
+    for counts in document_counts:
+        document_frequency.update(counts.keys())
+
+    total = len(document_counts)
+    query_words = set(relevance_tokens(query))
+    idf = {
+        word: math.log(1 + (total - document_frequency[word] + 0.5) / (document_frequency[word] + 0.5))
+        for word in query_words if word in document_frequency
+    }
+
+    scores = []
+    for counts, length in zip(document_counts, document_lengths):
+        length_norm = k1 * (1 - b + b * length / average_length)
+        scores.append(sum(
+            weight * counts[word] * (k1 + 1) / (counts[word] + length_norm)
+            for word, weight in idf.items() if word in counts
+        ))
+    return scores
+
+
+def rank_by_relevance(links, bullet_resume, min_score=0, top_k=0, debug=False):
+    if debug:
+        cprint("rank_by_relevance","yellow")
+
+    # Score every page that has text against the resume, pages without text carry on and get reported as errors later
+    texts = {link: get_page_text(link, 720) for link in links}
+    scored_links = [link for link in links if texts[link]]
+    unscored_links = [link for link in links if not texts[link]]
+
+    scores = bm25_scores(bullet_resume, [texts[link] for link in scored_links])
+    if not scores:
+        return links
+
+    # Scores are relative to the best match in this run, so min_score is a fraction from 0 to 1
+    best_score = max(scores) or 1
+    ranked = sorted(zip(scored_links, (score / best_score for score in scores)), key=lambda pair: pair[1], reverse=True)
+
+    kept = [link for link, score in ranked if score >= min_score]
+    if top_k:
+        kept = kept[:top_k]
+
+    # The dropped links aren't marked seen, so they're checked again next run, but list them so they aren't lost
+    # without a trace
+    kept_links = set(kept)
+    dropped = [(link, score) for link, score in ranked if link not in kept_links]
+    if dropped:
+        cprint(f"Dropped {len(dropped)} of {len(ranked)} pages as weak matches for the resume:", 'yellow')
+        for link, score in dropped:
+            print(f"\t{round(score, 3)} {link}")
+    if debug:
+        for link, score in ranked:
+            if link in kept_links:
+                print(f"\t{round(score, 3)} kept {link}")
+
+    return kept + unscored_links
+
+
+# Bump a version whenever its prompt changes, so the replies to the old prompt aren't reused. The rating version
+# covers both the single and the batch rating prompts, they ask the same question
+prompt_versions = {
+    'summary': 1,
+    'rating': 1,
+    'summary_rating': 1,
+}
+
+
+def llm_cache_key(kind, model, *inputs):
+    # Replies are cached by what was asked rather than by link, so the same job text at two links is only summarized
+    # once, and a changed resume or prompt gets a new key and a fresh reply
+    key = json.dumps([kind, prompt_versions[kind], model, *inputs])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def get_llm_cached(key):
+    result = get_llm_result(key)
+    count_llm_stat('cache_hits' if result is not None else 'cache_misses')
+    return result
+
+
+def simhash(text):
+    # A 64 bit fingerprint of the text where similar texts get similar fingerprints, so the same job posted on two
+    # sites with slightly different wording, headers, or footers comes out only a few bits apart. Built from every
+    # run of three words, so word order matters but small edits only change a few of them
+    words = re.findall(r'\w+', text.lower())
+    shingles = [' '.join(words[i:i + 3]) for i in range(max(1, len(words) - 2))]
+
+    weights = [0] * 64
+    for shingle in shingles:
+        shingle_hash = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += 1 if shingle_hash >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def remove_near_duplicate(link, max_distance=3, debug=False, kept_links=()):
+    # Returns the link if it's a new job, or None if it's the same job as a link that was rated in an earlier run or
+    # is in kept_links, the links this run has already passed on
+    page_content = get_page_text(link, 720)
+
+    # Pages without text can't be compared, they carry on and get reported as errors later
+    if not page_content:
+        return link
+
+    fingerprint = simhash(page_content)
+    representative = find_near_duplicate(link, fingerprint, max_distance)
+
+    if representative is None or representative == link:
+        save_fingerprint(link, fingerprint, link)
+        return link
+
+    # Group it with the link that was seen first, as long as that one has been rated or is on its way to being rated.
+    # It's only skipped in future runs once the representative is rated, until then the representative might still
+    # drop out and leave this copy to take its place
+    representative_rated = is_seen(representative, ['rated'])
+    if representative_rated or representative in kept_links:
         if debug:
-            page_content = get_page_content(driver, url, 0, False)  # for debug disable cache
-        else:
-            page_content = get_page_content(driver, url, 2, False)  # 2 hours
-        
-        if debug:
-            print(f"Got page content")
-            print(f"Type of 'page_content': {type(page_content)}")
-            if isinstance(page_content, str):
-                print(f"Length of 'page_content': {len(page_content)}")
-
-        # If the page content was successfully fetched
-        if page_content:
-            # Extract the links from the page content
-            if debug:
-                print(f"Extracting links")
-            fresh_links = extract_links(page_content)
-            if debug:
-                print(f"Extracted {len(fresh_links)} links")
+            print(f"{link} is a duplicate of {representative}")
+        save_fingerprint(link, fingerprint, representative)
+        if representative_rated:
+            mark_seen(link, 'duplicate')
+        return None
 
-            # Clean the extracted links by making sure they contain the search site URL and removing duplicates
-            fresh_links = link_cleaner(fresh_links, search_sites)
-            if debug:
-                print(f"Cleaned {len(fresh_links)} links")
+    # The representative was never rated (it was dropped, or its run was abandoned) and isn't in this run, so this
+    # copy takes its place rather than the job never being reported
+    if debug:
+        print(f"{link} takes over from {representative}, which was never rated")
+    move_cluster(representative, link)
+    save_fingerprint(link, fingerprint, link)
+    return link
+
+
+# How much of a page goes into the summary prompt. max_tokens caps the page text, 0 sends all of it
+summary_input_settings = {
+    'max_tokens': 3000,
+}
+
+# Headings that start a section with nothing about the job itself, the section is left out of the prompt up to the
+# next heading. Only a line that's nothing but the heading counts, so "Apply best practices in SEO" isn't taken for
+# "Apply". Any other heading ends the skipped section, so "Key Responsibilities" after "About Us" is kept. Short
+# unpunctuated lines in a benefits list can end it early too, that costs a few tokens but never drops the job itself
+low_value_headings = re.compile(
+    r'^(benefits|perks|what we offer|why (work|join)|about (us|the company|our company)|who we are|our (story|values|culture)|'
+    r'equal (employment )?opportunity|eeo|diversity|privacy|cookies?|share (this|the) job|similar jobs|related jobs|'
+    r'more jobs|recommended jobs|people also viewed|apply( now)?|how to apply|follow us|connect with us|legal)\s*:?$',
+    re.IGNORECASE,
+)
+
+# Paragraphs that are boilerplate wherever they show up
+low_value_paragraphs = re.compile(
+    r'equal opportunity employer|reasonable accommodation|without regard to (race|age)|e-verify|we use cookies|'
+    r'this (website|site) uses cookies|all rights reserved|privacy policy|terms of (use|service)',
+    re.IGNORECASE,
+)
+
+
+@lru_cache(maxsize=None)
+def get_token_encoding(model):
+    # tiktoken downloads the encoding the first time it's used. If that fails (no network, a proxy in the way) the
+    # tokens are estimated from the length instead, rather than failing every summary. None means estimate
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        cprint(f"Couldn't load the tiktoken encoding for {model}, estimating tokens from the length instead: {e}", 'red')
+        return None
 
-            # Add the cleaned links to the all_links list
-            all_links.extend(fresh_links)
 
-    # Close the browser
-    driver.quit()
+def count_tokens(text, model="gpt-4o-mini"):
+    encoding = get_token_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
 
-    # Return the list of all links
-    return all_links
 
+def truncate_to_tokens(text, max_tokens, model="gpt-4o-mini"):
+    encoding = get_token_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
 
-def process_links(links, search_words, must_have_words, anti_kewords):
 
-    return_count = 0
+def is_heading(paragraph):
+    # Short lines without closing punctuation, like "Benefits" or "About Us:". Bullet points are never headings, even
+    # when they're as short as one
+    if re.match(r'^([-*•●▪]|\d+[.)])\s', paragraph):
+        return False
+    return len(paragraph.split()) <= 6 and not paragraph.rstrip().endswith(('.', '!', '?', ','))
 
-    # Initialize the Selenium browser
-    driver = initialize_selenium_browser()
 
-    for link in links:
-        # Fetch the page content and cache it for 30 days (720 hours = 30 days)
-        page_content_raw = get_page_content(driver, link, 720)
+def trim_summary_input(page_content, model="gpt-4o-mini", debug=False):
+    # Cut the page text down to the parts worth paying for: skip the benefits, company blurb, legal, and related job
+    # sections, drop boilerplate and repeated paragraphs, and stop once the token budget is used up
+    max_tokens = summary_input_settings['max_tokens']
 
-        # Extract the body text from the page content
-        page_content = get_page_body_text(page_content_raw)
+    kept = []
+    seen_paragraphs = set()
+    skipping_section = False
+    used_tokens = 0
+    for paragraph in page_content.split('\n\n'):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
 
-        # If there is body text
-        if page_content:
-            # Check if any of the search words are in the body text
-            found_word = find_keywords(page_content, search_words, must_have_words, anti_kewords)
+        # A heading decides whether the section under it is kept
+        if is_heading(paragraph):
+            skipping_section = bool(low_value_headings.match(paragraph))
+        if skipping_section or low_value_paragraphs.search(paragraph):
+            continue
 
-            # If a search word was not found
-            if not found_word:
-                # Log the link
-                with open("scanned_sites.log", 'a') as file:
-                    file.write(f"{link}\n")
+        # Sites that paginate often repeat the same header and footer on every page
+        normalized = re.sub(r'\s+', ' ', paragraph.lower())
+        if normalized in seen_paragraphs:
+            continue
+        seen_paragraphs.add(normalized)
 
-                return_count += 1
+        # Cut the paragraph that goes over the budget, and leave out the rest
+        paragraph_tokens = count_tokens(paragraph, model)
+        if max_tokens > 0 and used_tokens + paragraph_tokens > max_tokens:
+            kept.append(truncate_to_tokens(paragraph, max_tokens - used_tokens, model))
+            break
+        kept.append(paragraph)
+        used_tokens += paragraph_tokens
 
-    # Quit the driver after processing all links
-    driver.quit()
+    trimmed = '\n\n'.join(part for part in kept if part)
 
-    return return_count
+    # Trimming shouldn't throw away the whole page, if it did something was misread so send it as it was, capped
+    if len(trimmed) < 50:
+        trimmed = truncate_to_tokens(page_content, max_tokens, model) if max_tokens > 0 else page_content
 
-def generate_gpt_summary(link, open_ai_key, debug=False):
-    # Fetch the page content and cache it for 30 days (720 hours = 30 days)
-    page_content_raw = get_page_content(initialize_selenium_browser(),link, 720, True)
+    saved_tokens = count_tokens(page_content, model) - count_tokens(trimmed, model)
+    count_llm_stat('tokens_trimmed', max(0, saved_tokens))
+    if debug:
+        print(f"Summary input trimmed by {saved_tokens} tokens to {count_tokens(trimmed, model)}")
 
-    # Extract the body text from the page content
-    page_content = get_page_body_text(page_content_raw, False, True)
+    return trimmed
+
+
+def generate_gpt_summary(link, open_ai_key, debug=False):
+    # Get the body text of the page, it was already extracted and cached when the keywords were checked
+    page_content = get_page_text(link, 720, True)
 
     if page_content==False:
         print(f"page content is false for {link}")
@@ -533,27 +1633,29 @@ def generate_gpt_summary(link, open_ai_key, debug=False):
 
     # If there is page content and it's at least 50 characters long
     if page_content and len(page_content) >= 50:
-        # Generate the filename for the summary file
-        filename = f"{hashlib.md5(link.encode()).hexdigest()}_summary.txt"
-        filepath = os.path.join('cached_pages', filename)
+        # Only the parts of the page about the job go into the prompt
+        model = "gpt-4o-mini"
+        page_content = trim_summary_input(page_content, model, debug)
 
-        # If the summary file doesn't exist
-        if not os.path.exists(filepath):
+        # Look for a summary of the same text from an earlier run, or from another link
+        summary_key = llm_cache_key('summary', model, page_content)
+        job_summary = get_llm_cached(summary_key)
+
+        # If the summary isn't cached
+        if job_summary is None:
             # Generate a summary of the page content using the GPT-3.5-turbo model
             prompt = f"Please read this job listing and write a concise summary of required skills, degrees, etc:\n\n{page_content}"
-            job_summary = gpt_me(prompt, "gpt-4o-mini", open_ai_key, debug)
+            job_summary = gpt_me(prompt, model, open_ai_key, debug)
 
             if job_summary==False:
                 print(f"Error: job summary is false for {link}")
                 return False
             else:
-                # Save the summary to the file
-                with open(filepath, 'w') as file:
-                    file.write(job_summary)
-        else:
-            # If the summary file exists, read the summary from the file
-            with open(filepath, 'r') as file:
-                job_summary = file.read()
+                set_llm_result(summary_key, 'summary', job_summary)
+
+        # Save the summary for the link, that's where the rating and the report read it from
+        if get_cached(link, 'summary') != job_summary:
+            set_cached(link, 'summary', job_summary)
 
         # Return the summary
         return job_summary
@@ -566,28 +1668,24 @@ def generate_gpt_job_match(link, bullet_resume, open_ai_key, debug=False):
     if debug:
         cprint("generate_gpt_job_match","yellow")
 
-    filename = f"{hashlib.md5(link.encode()).hexdigest()}_summary.txt"
-    filepath = os.path.join('cached_pages', filename)
+    job_summary = get_cached(link, 'summary')
 
-    if not os.path.exists(filepath):
+    if job_summary is None:
         return False
-    else:
-        with open(filepath, 'r') as file:
-            job_summary = file.read()
     if len(job_summary) >=25:
-        filename = f"{hashlib.md5(link.encode()).hexdigest()}_rating.txt"
-        filepath = os.path.join('cached_pages', filename)
+        # Look for a rating of the same summary against the same resume
+        model = "gpt-4o-mini"
+        rating_key = llm_cache_key('rating', model, bullet_resume, job_summary)
+        job_is_a_good_match = get_llm_cached(rating_key)
 
-        if not os.path.exists(filepath):
+        if job_is_a_good_match is None:
             # Use the LLM to generate a summary of the job listing
             prompt = f"Read the applicant's RESUME and JOB SUMMARY below and determine if the applicant is a good fit for this job on a scale of 1 to 10. 1 is a bad fit, 10 is a perfect fit. REPLY WITH AN INTEGER 1-10!!!\n\nJOB SUMMARY:  {bullet_resume}\n\nJOB SUMMARY:  {job_summary}"
-            job_is_a_good_match = gpt_range(prompt,"gpt-4o-mini", open_ai_key,True)
-            with open(filepath, 'w') as file:
-                file.write(str(job_is_a_good_match))
+            job_is_a_good_match = gpt_range(prompt, model, open_ai_key,True)
+            if job_is_a_good_match is not None:
+                set_llm_result(rating_key, 'rating', str(job_is_a_good_match))
 
-        else:
-            with open(filepath, 'r') as file:
-                job_is_a_good_match = file.read()
+        set_cached(link, 'rating', str(job_is_a_good_match))
 
 
         return job_is_a_good_match
@@ -596,30 +1694,133 @@ def generate_gpt_job_match(link, bullet_resume, open_ai_key, debug=False):
     return False
 
 
-def split_list(input_list, size):
-    # Calculate the length of the input list
-    length = len(input_list)
+def generate_gpt_job_matches(links, bullet_resume, open_ai_key, debug=False):
+    if debug:
+        cprint("generate_gpt_job_matches","yellow")
 
-    # Calculate the base size and the number of lists that will get an extra item
-    base_size = length // size
-    remainder = length % size
+    # Gather the jobs that have a summary but haven't been rated against this resume yet, links with the same summary
+    # share one rating
+    model = "gpt-4o-mini"
+    pending = {}
+    for link in links:
+        job_summary = get_cached(link, 'summary')
+        if job_summary is None or len(job_summary) < 25:
+            continue
 
-    # Initialize the output list
-    output = []
+        rating_key = llm_cache_key('rating', model, bullet_resume, job_summary)
+        cached_rating = get_llm_cached(rating_key)
+        if cached_rating is not None:
+            set_cached(link, 'rating', cached_rating)
+        else:
+            pending.setdefault(rating_key, (job_summary, []))[1].append(link)
+
+    jobs = list(pending.items())
+    if not jobs:
+        return links
+
+    # A single job doesn't gain anything from the batch prompt
+    if len(jobs) == 1:
+        for link in jobs[0][1][1]:
+            generate_gpt_job_match(link, bullet_resume, open_ai_key, debug)
+        return links
+
+    # Send the resume once, followed by every job summary, and ask for a rating for each job by number
+    job_list = "\n\n".join(f"JOB {number}:\n{job_summary}" for number, (_, (job_summary, _)) in enumerate(jobs, start=1))
+    prompt = (
+        "Read the applicant's RESUME and each of the numbered JOB SUMMARIES below and determine if the applicant is a good "
+        "fit for each job on a scale of 1 to 10. 1 is a bad fit, 10 is a perfect fit. Rate every job on its own. Reply with "
+        "JSON only, in the form {\"ratings\": [{\"job\": 1, \"rating\": 7}, {\"job\": 2, \"rating\": 3}]}"
+        f"\n\nRESUME:  {bullet_resume}\n\nJOB SUMMARIES:\n\n{job_list}"
+    )
+    reply = gpt_me(prompt, model, open_ai_key, debug, {"type": "json_object"})
+
+    # Pull the rating for each job number out of the reply, ignoring anything malformed
+    ratings = {}
+    try:
+        for entry in json.loads(reply or "{}").get("ratings", []):
+            job_number, rating = int(entry["job"]), int(entry["rating"])
+            if 1 <= rating <= 10:
+                ratings[job_number] = rating
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        if debug:
+            print(f"Couldn't read the batch ratings: {e}\n\t{str(reply)[:500]}")
 
-    # Initialize the iterator over the input list
-    iterator = iter(input_list)
+    for number, (rating_key, (_, job_links)) in enumerate(jobs, start=1):
+        if number in ratings:
+            set_llm_result(rating_key, 'rating', str(ratings[number]))
+            for link in job_links:
+                set_cached(link, 'rating', str(ratings[number]))
+        else:
+            # Any job the batch missed gets rated on its own
+            if debug:
+                print(f"No batch rating for {job_links[0]}, rating it on its own")
+            for link in job_links:
+                generate_gpt_job_match(link, bullet_resume, open_ai_key, debug)
+
+    return links
+
+
+# The reply format for the combined summary and rating, the API makes the model stick to it
+summary_rating_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "job_summary_rating",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "summary": {"type": "string"},
+                "rating": {"type": "integer"},
+            },
+            "required": ["summary", "rating"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def generate_gpt_summary_and_match(link, bullet_resume, open_ai_key, debug=False):
+    # Summarizes and rates the job in one request instead of two, the summary and rating are saved where
+    # generate_gpt_summary and generate_gpt_job_match save theirs, so the report reads them the same way
+    if debug:
+        cprint("generate_gpt_summary_and_match","yellow")
 
-    # Create the lists
-    for i in range(size):
-        # Determine the size of the current list
-        current_size = base_size + (i < remainder)
-        
-        # Create the current list
-        current_list = [next(iterator) for _ in range(current_size)]
-        
-        # Add the current list to the output
-        output.append(current_list)
+    page_content = get_page_text(link, 720, True)
+    if not page_content or len(page_content) < 50:
+        return False
+
+    model = "gpt-4o-mini"
+    page_content = trim_summary_input(page_content, model, debug)
+
+    # Look for a reply to the same page and resume from an earlier run, or from another link
+    summary_rating_key = llm_cache_key('summary_rating', model, bullet_resume, page_content)
+    reply = get_llm_cached(summary_rating_key)
+    from_cache = reply is not None
+
+    if reply is None:
+        prompt = (
+            "Read the job listing and the applicant's RESUME below. Write a concise summary of the job's required skills, "
+            "degrees, etc, and determine if the applicant is a good fit for this job on a scale of 1 to 10. 1 is a bad fit, "
+            "10 is a perfect fit."
+            f"\n\nRESUME:  {bullet_resume}\n\nJOB LISTING:\n\n{page_content}"
+        )
+        reply = gpt_me(prompt, model, open_ai_key, debug, summary_rating_format)
+
+    # The schema makes the reply well formed, but the rating can still be out of range
+    try:
+        parsed = json.loads(reply or "{}")
+        job_summary, rating = str(parsed["summary"]).strip(), int(parsed["rating"])
+    except (ValueError, TypeError, KeyError) as e:
+        print(f"Error: couldn't read the summary and rating for {link}: {e}")
+        return False
+
+    if not 1 <= rating <= 10 or len(job_summary) < 25:
+        print(f"Error: bad summary or rating for {link}")
+        return False
+
+    if not from_cache:
+        set_llm_result(summary_rating_key, 'summary_rating', reply)
+    set_cached(link, 'summary', job_summary)
+    set_cached(link, 'rating', str(rating))
 
-    # Return the output
-    return output
\ No newline at end of file
+    return rating
@@ -0,0 +1,133 @@
+
+# Local imports
+from functions import domain_scheduler, get_search_page_links, process_link, remove_near_duplicate, rank_by_relevance
+from functions import generate_gpt_summary, generate_gpt_summary_and_match, generate_gpt_job_match, generate_gpt_job_matches
+from pipeline import DomainQueue, Stage
+
+
+# What the stages search for, what they rate against, and how many workers they get. scroop.py fills these in from
+# the config, and benchmark.py from its own settings, so both run the same stages
+stage_settings = {
+    'search_sites': [],
+    'search_words': [],
+    'must_have_words': [],
+    'anti_kewords': [],
+    'bullet_resume': '',
+    'open_ai_key': '',
+    'threads': 8,
+    'llm_threads': 8,
+    'adaptive_concurrency': False,
+    'min_threads': 1,
+    'max_threads': 32,
+    'max_llm_threads': 32,
+    'rating_batch_size': 1,
+    'combined_summary_rating': False,
+    'relevance_min_score': 0,
+    'relevance_top_k': 0,
+    'near_duplicate_distance': 0,
+
+    # Stop sending on new links after this many, 0 for no limit. Debug mode only processes the first 10
+    'max_links': 0,
+}
+
+# Links scanned in earlier runs, loaded before the run starts
+scanned_sites = set()
+
+# Links that have already been sent on during this run, to remove duplicates between the searches
+run_links = set()
+
+# Links the near duplicate stage has passed on during this run, their copies are dropped
+near_duplicate_links = set()
+
+
+def search_stage(url):
+    # Get the cleaned links from one search page
+    return get_search_page_links(url, stage_settings['search_sites'])
+
+
+def dedupe_stage(link):
+    # Skip links that were scanned in an earlier run, or that another search already found
+    if link in scanned_sites or link in run_links:
+        return None
+
+    max_links = stage_settings['max_links']
+    if max_links and len(run_links) >= max_links:
+        return None
+
+    run_links.add(link)
+    return link
+
+
+def keyword_stage(link):
+    # Make sure the page is cached and drop pages without the keywords
+    if process_link(link, stage_settings['search_words'], stage_settings['must_have_words'], stage_settings['anti_kewords']):
+        return link
+    return None
+
+
+def near_duplicate_stage(link):
+    # The same job posted on several sites only goes to OpenAI once. One worker, so the set doesn't need a lock
+    link = remove_near_duplicate(link, stage_settings['near_duplicate_distance'], kept_links=near_duplicate_links)
+    if link:
+        near_duplicate_links.add(link)
+    return link
+
+
+def relevance_stage(links):
+    # Score all the pages against the resume at once, and only send the promising ones to OpenAI
+    return rank_by_relevance(links, stage_settings['bullet_resume'], stage_settings['relevance_min_score'], stage_settings['relevance_top_k'])
+
+
+def summary_stage(link):
+    # Links without a summary carry on too, they get reported as errors and tried again next run
+    if stage_settings['combined_summary_rating']:
+        generate_gpt_summary_and_match(link, stage_settings['bullet_resume'], stage_settings['open_ai_key'])
+    else:
+        generate_gpt_summary(link, stage_settings['open_ai_key'])
+    return link
+
+
+def rating_stage(item):
+    # With batching on, the stage hands over a list of links that are rated in one request, so the resume is only
+    # sent once per batch. Otherwise it's a single link
+    if stage_settings['rating_batch_size'] > 1:
+        return generate_gpt_job_matches(item, stage_settings['bullet_resume'], stage_settings['open_ai_key'])
+
+    generate_gpt_job_match(item, stage_settings['bullet_resume'], stage_settings['open_ai_key'])
+    return item
+
+
+def build_stages():
+    # A fresh set of stages for one run, laid out from stage_settings
+    settings = stage_settings
+
+    # With adaptive concurrency on, the fetching and OpenAI stages start at threads and llm_threads workers and are
+    # tuned within the bounds as the run goes
+    if settings['adaptive_concurrency']:
+        thread_bounds = {'min_workers': settings['min_threads'], 'max_workers': settings['max_threads']}
+        llm_thread_bounds = {'min_workers': settings['min_threads'], 'max_workers': settings['max_llm_threads']}
+    else:
+        thread_bounds = llm_thread_bounds = {}
+
+    # The browser stages share the browser pool and hand out links domain by domain, the LLM stages have their own
+    # number of workers. The dedupe stage has a single worker so its sets don't need a lock
+    stages = [
+        Stage('Searching', search_stage, workers=settings['threads'], flat=True, work_queue=DomainQueue(domain_scheduler.ready_in), **thread_bounds),
+        Stage('Removing Duplicates', dedupe_stage, workers=1),
+        Stage('Checking Keywords', keyword_stage, workers=settings['threads'], work_queue=DomainQueue(domain_scheduler.ready_in), **thread_bounds),
+        Stage('Summarizing', summary_stage, workers=settings['llm_threads'], **llm_thread_bounds),
+    ]
+
+    # The combined mode rates each job in the same request as its summary, so there's no separate rating stage
+    if not settings['combined_summary_rating']:
+        stages.append(Stage('Rating', rating_stage, workers=settings['llm_threads'], batch_size=settings['rating_batch_size'], **llm_thread_bounds))
+
+    # The relevance ranking has to see every page, so it holds the links back until all the keywords are checked
+    if settings['relevance_min_score'] > 0 or settings['relevance_top_k'] > 0:
+        stages.insert(3, Stage('Ranking Relevance', relevance_stage, gather=True))
+
+    # One worker, so two copies of the same job can't both be checked before either is saved
+    if settings['near_duplicate_distance'] > 0:
+        stages.insert(3, Stage('Removing Near Duplicates', near_duplicate_stage, workers=1))
+
+    return stages
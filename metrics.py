@@ -0,0 +1,179 @@
+
+# Standard library imports
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Latency buckets in seconds, from a cached page read up to a slow browser fetch or OpenAI request
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# What each metric is, for the HELP lines in the Prometheus file
+metric_help = {
+    'scroop_page_fetches': "Pages asked for, by domain, whether they came from the cache, and whether the fetch worked or the site pushed back",
+    'scroop_page_fetch_seconds': "Time to fetch a page that wasn't cached, by domain and fetcher",
+    'scroop_extraction_seconds': "Time to extract the main text from a page's HTML",
+    'scroop_link_extraction_seconds': "Time to pull the links out of a search page",
+    'scroop_keyword_checks': "Pages checked for keywords, by result",
+    'scroop_llm_request_seconds': "Time for each OpenAI request, by result",
+    'scroop_llm_requests': "OpenAI requests sent",
+    'scroop_llm_retries': "OpenAI requests retried",
+    'scroop_llm_rate_limited': "OpenAI requests refused for the rate limit",
+    'scroop_llm_errors': "OpenAI requests that failed for good",
+    'scroop_llm_throttle_seconds': "Time spent waiting on the local OpenAI rate limiter",
+    'scroop_llm_prompt_tokens': "Prompt tokens used",
+    'scroop_llm_completion_tokens': "Completion tokens used",
+    'scroop_llm_cache_hits': "OpenAI replies reused from the cache",
+    'scroop_llm_cache_misses': "OpenAI replies not found in the cache",
+    'scroop_llm_tokens_trimmed': "Tokens trimmed from summary inputs",
+    'scroop_stage_items': "Items through each pipeline stage, by what happened to them",
+    'scroop_stage_busy_seconds': "Time the stage's workers spent working, added up across workers",
+    'scroop_stage_seconds': "Time from the stage's first item starting to its last item finishing",
+    'scroop_stage_workers': "How many workers the stage was running at the end, after any tuning",
+    'scroop_run_seconds': "Time the whole run took",
+    'scroop_run_timestamp_seconds': "When the run finished",
+}
+
+
+class Metrics:
+    # Counters, gauges, and histograms for one run, safe to record from any thread. Each metric can be split by
+    # labels (like domain), given as keyword arguments. Everything is written out at the end of the run, as a
+    # Prometheus text file (the format the node exporter's textfile collector reads) and as JSON
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+        # Keyed by (name, labels), labels being a sorted tuple of (label, value) pairs
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def count(self, name, amount=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][position] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Times the block into a histogram. The labels can be changed inside the block, like setting the result once
+        # it's known
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def families(self):
+        # Every metric name with its type and samples, in a stable order
+        with self.lock:
+            recorded = [(self.counters, 'counter'), (self.gauges, 'gauge'), (self.histograms, 'histogram')]
+            families = {}
+            for store, kind in recorded:
+                for (name, labels), value in store.items():
+                    families.setdefault(name, (kind, []))[1].append((labels, value if kind != 'histogram' else dict(value, buckets=list(value['buckets']))))
+        return {name: (kind, sorted(samples)) for name, (kind, samples) in sorted(families.items())}
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
+
+    @staticmethod
+    def format_number(value):
+        if value == math.inf:
+            return '+Inf'
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def prometheus_text(self):
+        lines = []
+        for name, (kind, samples) in self.families().items():
+            # Counters get _total on the end of their name
+            family = f"{name}_total" if kind == 'counter' else name
+            lines.append(f"# HELP {family} {metric_help.get(name, name)}")
+            lines.append(f"# TYPE {family} {kind}")
+            for labels, value in samples:
+                if kind != 'histogram':
+                    lines.append(f"{family}{self.format_labels(labels)} {self.format_number(value)}")
+                else:
+                    # Buckets are cumulative, every observation is in the +Inf bucket
+                    for bound, bucket_count in zip(self.buckets, value['buckets']):
+                        lines.append(f"{name}_bucket{self.format_labels(labels, [('le', self.format_number(float(bound)))])} {bucket_count}")
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {value['count']}")
+                    lines.append(f"{name}_sum{self.format_labels(labels)} {self.format_number(value['sum'])}")
+                    lines.append(f"{name}_count{self.format_labels(labels)} {value['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # The same numbers as plain JSON, histograms get their count, total, average, and rough percentiles
+        output = {}
+        for name, (kind, samples) in self.families().items():
+            entries = []
+            for labels, value in samples:
+                entry = {'labels': dict(labels)}
+                if kind == 'histogram':
+                    entry.update({
+                        'count': value['count'],
+                        'sum': round(value['sum'], 4),
+                        'average': round(value['sum'] / value['count'], 4) if value['count'] else None,
+                        'p50': self.percentile(value, 0.5),
+                        'p95': self.percentile(value, 0.95),
+                    })
+                else:
+                    entry['value'] = round(value, 4) if isinstance(value, float) else value
+                entries.append(entry)
+            output[name] = {'type': kind, 'samples': entries}
+        return output
+
+    def percentile(self, histogram, fraction):
+        # The upper bound of the bucket the percentile falls in, None if it's past the last bucket
+        target = histogram['count'] * fraction
+        for bound, bucket_count in zip(self.buckets, histogram['buckets']):
+            if bucket_count >= target and bucket_count:
+                return bound
+        return None
+
+    def write(self, prometheus_path=None, json_path=None):
+        # Written to a temporary file and swapped in, so a collector never reads a half written file
+        outputs = []
+        if prometheus_path:
+            outputs.append((prometheus_path, self.prometheus_text()))
+        if json_path:
+            outputs.append((json_path, json.dumps(self.summary(), indent=2)))
+
+        for path, text in outputs:
+            temporary_path = f"{path}.tmp"
+            with open(temporary_path, 'w') as file:
+                file.write(text)
+            os.replace(temporary_path, path)
+
+
+# The metrics for the whole run, every module records into this one
+metrics = Metrics()
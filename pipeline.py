@@ -0,0 +1,435 @@
+
+# Standard library imports
+import queue
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+
+# Related third party imports
+from termcolor import cprint
+from tqdm import tqdm
+
+
+# Local imports
+from tracing import tracer
+
+
+# Put into a stage's queue to tell one of its workers there's nothing more coming
+stage_done = object()
+
+
+class DomainQueue:
+    # A stage queue for links that hands them out domain by domain in turn, instead of first in first out, so the
+    # workers are spread across sites rather than piling onto whichever one the searches happened to return first.
+    # ready_in(domain) says how many seconds until a domain can take another fetch, links from domains that are
+    # ready now go out first, and an idle worker only gets a link from a busy domain when nothing else is left
+
+    def __init__(self, ready_in=None):
+        self.ready_in = ready_in or (lambda domain: 0)
+
+        # Links waiting for each domain, and the order the domains take turns in
+        self.pending = {}
+        self.domains = deque()
+        self.count = 0
+
+        # stage_done markers that have been put, they're only handed out once every link has been
+        self.done_markers = 0
+        self.condition = threading.Condition()
+
+    def put(self, item, block=True, timeout=None):
+        with self.condition:
+            if item is stage_done:
+                self.done_markers += 1
+            else:
+                domain = urlparse(item).netloc
+                if domain not in self.pending:
+                    self.pending[domain] = deque()
+                    self.domains.append(domain)
+                self.pending[domain].append(item)
+                self.count += 1
+            self.condition.notify()
+
+    def qsize(self):
+        return self.count
+
+    def take(self, domain):
+        # Pop the domain's next link, and send the domain to the back of the line
+        item = self.pending[domain].popleft()
+        self.count -= 1
+        self.domains.remove(domain)
+        if self.pending[domain]:
+            self.domains.append(domain)
+        else:
+            del self.pending[domain]
+        return item
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                if self.domains:
+                    # The first domain in line that's ready now, otherwise the one that'll be ready soonest
+                    waits = [(self.ready_in(domain), position, domain) for position, domain in enumerate(self.domains)]
+                    ready = [entry for entry in waits if entry[0] <= 0]
+                    return self.take((ready or sorted(waits))[0][2])
+
+                if self.done_markers:
+                    self.done_markers -= 1
+                    return stage_done
+
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self.condition.wait(remaining)
+
+
+class Stage:
+    # One step of the pipeline. func is called with each item and returns the item to hand to the next stage, or
+    # something falsy to drop it. With flat set it returns a list of items instead, each passed on separately.
+    # With batch_size above 1, func is called with a list of up to batch_size items (waiting at most batch_wait
+    # seconds to fill it) and returns the list of items to pass on. With gather set, func is called once with every
+    # item, for work that has to see all of them at once, so nothing gets past this stage until the stages before
+    # it are finished. With max_workers above workers, the stage starts max_workers threads but only lets workers of
+    # them work at once, and a ConcurrencyController can move that limit anywhere between min_workers and max_workers
+
+    def __init__(self, name, func, workers=1, flat=False, queue_size=None, batch_size=1, batch_wait=5, work_queue=None, gather=False, min_workers=1, max_workers=None):
+        if gather:
+            workers, batch_size, batch_wait, max_workers = 1, float('inf'), None, 1
+
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers, max_workers or 0)
+        self.flat = flat or batch_size > 1
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+
+        # A bounded queue keeps a fast stage from running too far ahead of a slow one, unless the stage brings its own
+        self.queue = work_queue if work_queue is not None else queue.Queue(maxsize=queue_size or self.workers * 4)
+
+        # How many of the workers can be working at once, and how many are
+        self.min_workers = max(1, min(min_workers, workers))
+        self.limit = max(1, workers)
+        self.active = 0
+        self.gate = threading.Condition()
+
+        # Counters for the summary at the end of the run
+        self.received = 0
+        self.passed = 0
+        self.failed = 0
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self.first_started = None
+        self.last_finished = None
+        self.counter_lock = threading.Lock()
+
+        # Set up when the pipeline starts
+        self.progress = None
+        self.next_stage = None
+        self.running_workers = 0
+
+    def put(self, item):
+        with self.counter_lock:
+            self.received += 1
+            if self.progress is not None:
+                self.progress.total = self.received
+                self.progress.refresh()
+        self.queue.put(item)
+
+    def adaptive(self):
+        return self.workers > self.min_workers
+
+    def set_limit(self, limit):
+        with self.gate:
+            self.limit = max(self.min_workers, min(self.workers, limit))
+            self.gate.notify_all()
+        return self.limit
+
+    def acquire_slot(self):
+        # Wait until fewer than limit workers are working
+        with self.gate:
+            while self.active >= self.limit:
+                self.gate.wait()
+            self.active += 1
+
+    def release_slot(self):
+        with self.gate:
+            self.active -= 1
+            self.gate.notify()
+
+
+def memory_pressure():
+    # The fraction of the memory in use, from /proc/meminfo, None where that isn't available
+    try:
+        with open('/proc/meminfo') as file:
+            meminfo = {line.split(':')[0]: int(line.split()[1]) for line in file}
+        return 1 - meminfo['MemAvailable'] / meminfo['MemTotal']
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+class ConcurrencyController:
+    # Tunes how many workers each adaptive stage runs, so the thread counts don't have to be worked out by hand for
+    # every machine and every set of sites. Every interval seconds it looks at how many items each busy stage got
+    # through and how long each took. A stage whose throughput held up and whose items aren't taking much longer than
+    # usual gets another worker (additive increase), unless the last worker it got didn't raise its throughput at all,
+    # then it's at its limit and stays where it is. A stage whose throughput fell, or whose items started taking
+    # latency_tolerance times as long as usual (sites pushing back, the CPU or OpenAI saturated), is cut back by
+    # decrease_factor (multiplicative decrease). Every stage is cut back while memory use is over memory_limit
+    # (browsers are the usual culprit). Stages with nothing waiting are left alone, more workers wouldn't help them.
+    #
+    # "Usual" is the fastest time per item over the last latency_window checks, so a stretch of cached pages that take
+    # milliseconds soon stops counting, and doesn't make every real fetch after it look slow. After a cut the
+    # throughput and the usual time start over, since the stage is expected to get less done with fewer workers. A
+    # check with fewer than min_items finished waits for more rather than throwing them away, so a stage cut down to
+    # one slow worker still gets looked at
+
+    def __init__(self, interval=5, increase=1, decrease_factor=0.75, latency_tolerance=1.5, latency_window=6, memory_limit=0.9, min_items=3, debug=False):
+        self.interval = interval
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.latency_window = latency_window
+        self.memory_limit = memory_limit
+        self.min_items = min_items
+        self.debug = debug
+
+        # What each stage looked like at the last check, and its time per item at the recent checks
+        self.last = {}
+        self.recent_latencies = {}
+        self.grew = {}
+        self.adjustments = 0
+        self.stopped = threading.Event()
+
+    def run(self, stages):
+        while not self.stopped.wait(self.interval):
+            memory = memory_pressure()
+            for stage in stages:
+                if stage.adaptive():
+                    self.adjust(stage, memory)
+
+    def stop(self):
+        self.stopped.set()
+
+    def adjust(self, stage, memory, now=None):
+        now = time.monotonic() if now is None else now
+        with stage.counter_lock:
+            completed, busy_seconds = stage.completed, stage.busy_seconds
+        last_completed, last_busy_seconds, last_throughput, last_checked = self.last.get(stage.name, (0, 0.0, None, now - self.interval))
+
+        items = completed - last_completed
+        throughput = items / max(now - last_checked, 0.001)
+        latency = (busy_seconds - last_busy_seconds) / items if items else None
+
+        limit = stage.limit
+        if memory is not None and memory > self.memory_limit:
+            limit = int(limit * self.decrease_factor)
+            reason = f"memory {round(memory * 100)}% used"
+        elif stage.queue.qsize() == 0:
+            # Nothing waiting, start the next check from here
+            self.last[stage.name] = (completed, busy_seconds, last_throughput, now)
+            return
+        elif items < self.min_items:
+            # Too little to go on yet, the next check looks at this one's items too
+            return
+        else:
+            recent_latencies = self.recent_latencies.setdefault(stage.name, deque(maxlen=self.latency_window))
+            usual_latency = min(recent_latencies, default=latency)
+            if last_throughput is not None and throughput < last_throughput * 0.9:
+                limit = int(limit * self.decrease_factor)
+                reason = f"throughput fell to {round(throughput, 2)}/s from {round(last_throughput, 2)}/s"
+            elif latency > usual_latency * self.latency_tolerance:
+                limit = int(limit * self.decrease_factor)
+                reason = f"{round(latency, 2)}s per item, usually {round(usual_latency, 2)}s"
+            elif self.grew.get(stage.name) and last_throughput is not None and throughput <= last_throughput:
+                reason = f"{round(throughput, 2)}/s, no faster with the last worker added"
+            else:
+                limit += self.increase
+                reason = f"{round(throughput, 2)}/s at {round(latency, 2)}s per item, with a backlog"
+            recent_latencies.append(latency)
+
+        # After a cut, the next check sets a new throughput and time per item to compare against
+        if limit != stage.limit:
+            self.grew[stage.name] = limit > stage.limit
+        if limit < stage.limit:
+            self.last[stage.name] = (completed, busy_seconds, None, now)
+            self.recent_latencies.pop(stage.name, None)
+        else:
+            self.last[stage.name] = (completed, busy_seconds, throughput, now)
+
+        old_limit = stage.limit
+        new_limit = stage.set_limit(limit)
+        if new_limit != old_limit:
+            self.adjustments += 1
+            if stage.progress is not None:
+                stage.progress.set_postfix(workers=new_limit)
+            if self.debug:
+                print(f"{stage.name}: {old_limit} -> {new_limit} workers, {reason}")
+
+
+class Pipeline:
+    # Runs each item through the stages as soon as the previous stage is done with it, instead of waiting for every
+    # item to finish one stage before starting the next. Every stage has its own pool of worker threads, so slow
+    # browser work and slow API work overlap and the run takes about as long as its slowest stage
+
+    def __init__(self, stages, debug=False, checkpoint=None, controller=None):
+        self.stages = stages
+        self.debug = debug
+
+        # Resizes the adaptive stages while the pipeline runs
+        self.controller = controller
+
+        # Called with the stage, the item, and what the stage passed on, each time a stage finishes an item without an
+        # error, so the progress of a run can be saved
+        self.checkpoint = checkpoint
+        self.results = []
+        self.results_lock = threading.Lock()
+
+        # Link the stages together
+        for stage, next_stage in zip(stages, stages[1:] + [None]):
+            stage.next_stage = next_stage
+
+    def stage(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def next_batch(self, stage):
+        # Returns the items to work on and whether the stage has been told it's done
+        item = stage.queue.get()
+        if item is stage_done:
+            return [], True
+        if stage.batch_size == 1:
+            return item, False
+
+        # Keep collecting until the batch is full, the wait runs out, or the input ends
+        batch = [item]
+        deadline = None if stage.batch_wait is None else time.time() + stage.batch_wait
+        while len(batch) < stage.batch_size:
+            try:
+                item = stage.queue.get(timeout=None if deadline is None else max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if item is stage_done:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def worker(self, stage):
+        finished = False
+        while not finished:
+            # Only limit workers take work at once, the rest wait here
+            stage.acquire_slot()
+            try:
+                item, finished = self.next_batch(stage)
+                if finished and not item:
+                    break
+                self.work(stage, item)
+            finally:
+                stage.release_slot()
+
+        # The last worker out tells the next stage that nothing more is coming
+        with stage.counter_lock:
+            stage.running_workers -= 1
+            last_worker = stage.running_workers == 0
+        if last_worker and stage.next_stage is not None:
+            for _ in range(stage.next_stage.workers):
+                stage.next_stage.queue.put(stage_done)
+
+    def work(self, stage, item):
+        started = time.time()
+        with stage.counter_lock:
+            if stage.first_started is None:
+                stage.first_started = started
+        failed = False
+        try:
+            # The span is named for the stage and carries the link, or the links for a batch, so each link's
+            # path through the stages can be pieced together in the trace
+            trace_args = {'links': item} if isinstance(item, list) else {'link': item}
+            with tracer.span(stage.name, 'stage', **trace_args):
+                output = stage.func(item)
+        except Exception as e:
+            # One bad item shouldn't take down the whole run
+            cprint(f"{stage.name} - An error occurred: {e}\n\t{item}", 'red')
+            output = None
+            failed = True
+            with stage.counter_lock:
+                stage.failed += 1
+
+        outputs = (output or []) if stage.flat else ([output] if output else [])
+
+        if self.checkpoint is not None and not failed:
+            self.checkpoint(stage, item, outputs)
+
+        with stage.counter_lock:
+            stage.last_finished = time.time()
+            stage.busy_seconds += stage.last_finished - started
+            stage.completed += len(item) if stage.batch_size > 1 else 1
+            stage.passed += len(outputs)
+            if stage.progress is not None:
+                stage.progress.update(len(item) if stage.batch_size > 1 else 1)
+
+        # Hand the output to the next stage, or collect it if this is the last stage
+        for output in outputs:
+            if stage.next_stage is not None:
+                stage.next_stage.put(output)
+            else:
+                with self.results_lock:
+                    self.results.append(output)
+
+    def run(self, items, stage_items=None):
+        # items go into the first stage, stage_items can start items partway through, keyed by stage name
+        for position, stage in enumerate(self.stages):
+            stage.progress = tqdm(total=0, desc=stage.name, position=position, leave=True)
+            if stage.adaptive():
+                stage.progress.set_postfix(workers=stage.limit)
+
+        threads = []
+        for stage in self.stages:
+            stage.running_workers = stage.workers
+            for number in range(stage.workers):
+                thread = threading.Thread(target=self.worker, args=(stage,), name=f"{stage.name} {number + 1}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        # The controller starts with the workers, putting the items in below blocks once the first queue fills up
+        if self.controller is not None:
+            threading.Thread(target=self.controller.run, args=(self.stages,), name="Concurrency Controller", daemon=True).start()
+
+        # Items that start partway through go in first, before the stages ahead of them can finish
+        for name, named_items in (stage_items or {}).items():
+            for item in named_items:
+                self.stage(name).put(item)
+
+        for item in items:
+            self.stages[0].put(item)
+
+        # Once the input runs out, shut the stages down one after another as each drains
+        for _ in range(self.stages[0].workers):
+            self.stages[0].queue.put(stage_done)
+
+        for thread in threads:
+            thread.join()
+
+        if self.controller is not None:
+            self.controller.stop()
+
+        for stage in self.stages:
+            stage.progress.close()
+
+        return self.results
+
+    def summary(self):
+        return {
+            stage.name: {
+                'received': stage.received,
+                'passed': stage.passed,
+                'failed': stage.failed,
+                'busy_seconds': round(stage.busy_seconds, 2),
+                'seconds': round(stage.last_finished - stage.first_started, 2) if stage.first_started else 0,
+                'workers': stage.limit,
+            }
+            for stage in self.stages
+        }
@@ -5,201 +5,220 @@ Scroop is used to automate a job search process. It works by searching a list of
 
 """
 
-import hashlib
-import os
-import random
+import argparse
+import time
 from datetime import datetime
 from urllib.parse import quote
-from concurrent.futures import ThreadPoolExecutor
-import itertools
 from operator import itemgetter
-import shutil
 import csv
 import pandas as pd
 
 from termcolor import cprint
-from tqdm import tqdm
 
 from config import *
+from cache import *
 from functions import *
+from pipeline import *
+from job_stages import *
+from metrics import *
+from tracing import *
 
 import subprocess
 
 
+# --resume picks up the last run that didn't finish, instead of starting over from the searches
+parser = argparse.ArgumentParser(description="Search job sites and rate the jobs against a resume")
+parser.add_argument('--resume', action='store_true', help="continue the last run that stopped before the report")
+args = parser.parse_args()
+
+
 # Define the output filenames
 timestamp = datetime.now().strftime('%m-%d-%Y_%I-%M-%p')
 output_csv_filename = f"job_search_{timestamp}.csv"
 output_summary_filename = f"job_match_summaries_{timestamp}.txt"
 
 
-# The log file is used to keep track of which sites have been scanned, Create the log file if it doesn't exist
-with open("scanned_sites.log", 'a') as _:
-    pass
-
-# Create the cache folder if it doesn't exist
-os.makedirs('cached_pages', exist_ok=True)
-
-
-
-####
-#Search the sites for jobs
-####
-
-# Generate list of search URLs, combining each site with each search word
-site_search_list = [f"{site}{quote(word)}" for site in search_sites for word in search_words]
+# Start the processes that parse pages and extract text, before any threads are started
+start_extraction_pool(extraction_processes)
 
-# Randomize the order
-random.shuffle(site_search_list)
+# Trace where each link spends its time, if there's somewhere to write the trace
+if trace_file:
+    tracer.enable()
 
-print("Getting Searches in parallel...")
+# Set how cached pages are compressed
+cache_settings['compression'] = cache_compression
+cache_settings['level'] = cache_compression_level
 
-if debug: #this debug will record the time it takes to perform the searches/gpts/etc so that you can determine the correct number fo threads to use
-    # Get current date and time
-    now = datetime.now()
-    # Format datetime object to a pretty string
-    pretty_timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-    # Append the pretty_timestamp to the file 'threads.log'
-    with open('threads.log', 'a') as f:
-        f.write(pretty_timestamp + '\n')
-    now = datetime.now()
-    before_timestamp = now.timestamp()
+# Bring any pages cached and links scanned by older versions of scroop into the cache database, and compress the
+# pages that were cached before compression, this only happens once
+migrate_cached_pages('cached_pages', debug)
+migrate_scanned_sites_log('scanned_sites.log', debug)
+compress_cached_pages(debug)
 
+# The seen links keep track of which sites have been scanned, forget the ones old enough to look at again
+expire_seen_links(seen_link_expire_days)
 
-split_site_search_list = split_list(site_search_list, threads)
+# Point the OpenAI client at the configured server, and keep it under the account's rate limits
+openai_settings['base_url'] = openai_base_url
+openai_rate_limiter.configure(openai_requests_per_minute, openai_tokens_per_minute)
 
-# Get the search links from the search sites
-with ThreadPoolExecutor(max_workers=threads) as executor:
-    links = list(tqdm(executor.map(get_search_links, split_site_search_list, itertools.repeat(search_sites, len(split_site_search_list))), total=len(split_site_search_list)))
+# Cap how much of each page goes into the summary prompt
+summary_input_settings['max_tokens'] = summary_max_tokens
 
-if debug:
-    now = datetime.now()
-    after_timestamp = now.timestamp()
+# Tell the fetcher which sites can be downloaded directly and which need a browser
+domain_fetch_modes.update(fetch_modes)
 
-    site_search_log = f"get_search_links {threads} - {(after_timestamp - before_timestamp)/len(site_search_list)} seconds per thread"
+# Set how keywords are matched on the pages
+keyword_settings['word_boundaries'] = keyword_word_boundaries
 
-    with open('threads.log', 'a') as f:
-        f.write(site_search_log + '\n')
+# Limit how hard each site gets hit
+domain_scheduler.configure(max_per_domain=domain_max_concurrency, min_delay=domain_min_delay)
 
+# Size the shared browser pool, every stage borrows browsers from it
+browser_pool.configure(size=browsers, max_pages=browser_max_pages, debug=debug)
 
-# Flatten the list of lists of links into a single list of links
-links = [link for sublist in links for link in sublist]
+# Set how long the browser waits for pages to render
+page_wait_settings['timeout'] = page_load_timeout
+domain_readiness_selectors.update(readiness_selectors)
 
-print(f"\nTotal Links Found: {len(links)}")
 
 
 ####
-#Basic clean on the links, removing previously scanned sites and duplicates  
+#Set up the stages each link flows through
 ####
 
-# Read the file 'scanned_sites.log' into a set for faster lookup
-with open('scanned_sites.log', 'r') as file:
-    scanned_sites = set(file.read().splitlines())
-
-# Use a list comprehension to filter out links that have been scanned
-links = [link for link in links if link not in scanned_sites]
-print(f"Links Remaining after Previously Scanned removed: {len(links)}")
-
-# Use a set to remove duplicate links, then convert back to a list
-links = list(set(links))
-print(f"Links Remaining after Duplicates Removed: {len(links)}\n")
+# Load the previously scanned links into a set for faster lookup
+scanned_sites.update(load_seen_links())
+
+# What the stages search for and rate against, and how many workers they get
+stage_settings.update({
+    'search_sites': search_sites,
+    'search_words': search_words,
+    'must_have_words': must_have_words,
+    'anti_kewords': anti_kewords,
+    'bullet_resume': bullet_resume,
+    'open_ai_key': open_ai_key,
+    'threads': threads,
+    'llm_threads': llm_threads,
+    'adaptive_concurrency': adaptive_concurrency,
+    'min_threads': min_threads,
+    'max_threads': max_threads,
+    'max_llm_threads': max_llm_threads,
+    'rating_batch_size': rating_batch_size,
+    'combined_summary_rating': combined_summary_rating,
+    'relevance_min_score': relevance_min_score,
+    'relevance_top_k': relevance_top_k,
+    'near_duplicate_distance': near_duplicate_distance,
+})
+
+# In debug mode only the first 10 new links are processed
+if debug:
+    stage_settings['max_links'] = 10
 
+stages = build_stages()
 
 
 ####
-#Cache pages and skip links without the keyword in the body of the page
-###
+#Keep track of how far each link gets, so a run that dies can be resumed
+####
 
-random.shuffle(links)
+resume_run = get_unfinished_run() if args.resume else None
+if args.resume and resume_run is None:
+    print("No unfinished run to resume, starting a new one")
+run_id = resume_run or start_run()
 
-if debug:
-    print("Debug Mode: Only processing 10 links")
-    links = random.sample(links, 10)
+stage_positions = {stage.name: position for position, stage in enumerate(stages)}
 
-print("Make Sure Pages are Cached & Remove Pages without Keywords...")
-if debug:
-    if len(links) > 0:
-        now = datetime.now()
-        before_timestamp = now.timestamp()
 
-# Assuming links and threads are defined somewhere above
-split_links = split_list(links, threads)
+def checkpoint(stage, item, outputs):
+    # Record which stage each link made it through. The search stage takes search pages and passes on links, the
+    # batch and gather stages take lists of links, and the rest take a link at a time
+    position = stage_positions[stage.name]
+    if stage.name == 'Searching':
+        record_run_search(run_id, item)
+        for link in outputs:
+            record_run_link(run_id, link, stage.name, position, 'passed')
+        return
 
-with ThreadPoolExecutor(max_workers=threads) as executor:
-    skipped = sum(tqdm(executor.map(process_links, split_links, itertools.repeat(search_words, len(split_links)), itertools.repeat(must_have_words, len(split_links)), itertools.repeat(anti_kewords, len(split_links))), total=len(split_links)))
-    
-if debug:
-    if len(links) > 0:
-        now = datetime.now()
-        after_timestamp = now.timestamp()
-        site_search_log = f"process_links {threads} - {(after_timestamp - before_timestamp)/len(links)} seconds per thread"
-        with open('threads.log', 'a') as f:
-            f.write(site_search_log + '\n')
+    passed = set(outputs)
+    for link in (item if isinstance(item, list) else [item]):
+        # The dedupe stage drops the second copy of a link, that shouldn't undo the first copy getting through
+        if link in passed or stage.name != 'Removing Duplicates':
+            record_run_link(run_id, link, stage.name, position, 'passed' if link in passed else 'dropped')
 
 
-# Read the file 'scanned_sites.log' into a set for faster lookup
-with open('scanned_sites.log', 'r') as file:
-    scanned_sites = set(file.read().splitlines())
+# Work out where each link left off. Links go into the stage after the last one they got through, and a link whose
+# stage isn't in the pipeline anymore (the config changed) starts again at the keyword check, its page is cached
+finished_links = []
+resume_items = {}
+searched = set()
+if resume_run:
+    searched = load_run_searches(resume_run)
+    for url, stage_name, status in load_run_links(resume_run):
+        # Links that got past the dedupe stage aren't let through it again if an unfinished search finds them
+        if stage_name != 'Searching':
+            run_links.add(url)
 
-# Use a list comprehension to filter out links that have been scanned
-links = [link for link in links if link not in scanned_sites]
+        if status == 'passed':
+            position = stage_positions.get(stage_name, stage_positions['Removing Duplicates'])
 
-print(f"Links Remaining after Pages without Keywords removed: {len(links)}")
+            # Links past the near duplicate stage still keep their copies out
+            if position >= stage_positions.get('Removing Near Duplicates', len(stages)):
+                near_duplicate_links.add(url)
 
+            if position + 1 < len(stages):
+                resume_items.setdefault(stages[position + 1].name, []).append(url)
+            else:
+                finished_links.append(url)
 
+    print(f"Resuming run {resume_run}: {len(searched)} searches done, {sum(len(items) for items in resume_items.values())} links in progress, {len(finished_links)} links finished")
+
+controller = ConcurrencyController(memory_limit=adaptive_memory_limit / 100, debug=debug) if adaptive_concurrency else None
+pipeline = Pipeline(stages, debug, checkpoint, controller)
 
 
 ####
-#Generate job description summaries
+#Search the sites for jobs, and stream each link through the rest of the stages as soon as it's found
 ####
 
-print("\nGenerating GPT Summaries of Jobs...")
-
-if debug:
-    if len(links) > 0:
-        now = datetime.now()
-        before_timestamp = now.timestamp()
+# Generate list of search URLs, combining each site with each search word. The search stage takes the sites in turn,
+# so there's no need to shuffle them
+site_search_list = [f"{site}{quote(word)}" for site in search_sites for word in search_words]
 
-random.shuffle(links)
-with ThreadPoolExecutor(max_workers=threads) as executor:
-    list(tqdm(executor.map(generate_gpt_summary, links, itertools.repeat(open_ai_key, len(links))), total=len(links)))
+# Searches finished before a resumed run stopped aren't done again
+site_search_list = [url for url in site_search_list if url not in searched]
 
 if debug:
-    if len(links) > 0:
-        now = datetime.now()
-        after_timestamp = now.timestamp()
-
-        site_search_log = f"generate_gpt_summary {threads} - {(after_timestamp - before_timestamp)/len(links)} seconds per thread"
+    print("Debug Mode: Only processing 10 links")
 
-        with open('threads.log', 'a') as f:
-            f.write(site_search_log + '\n')
+print("Searching, Filtering, Summarizing, and Rating Jobs...")
 
 
+links = finished_links + pipeline.run(site_search_list, resume_items)
 
+stage_counts = pipeline.summary()
+print(f"\nTotal Links Found: {stage_counts['Searching']['passed']}")
+print(f"Links Remaining after Previously Scanned and Duplicates Removed: {stage_counts['Removing Duplicates']['passed']}")
+print(f"Links Remaining after Pages without Keywords removed: {stage_counts['Checking Keywords']['passed']}")
+if 'Removing Near Duplicates' in stage_counts:
+    print(f"Links Remaining after Jobs Posted on Several Sites removed: {stage_counts['Removing Near Duplicates']['passed']}")
+if 'Ranking Relevance' in stage_counts:
+    print(f"Links Remaining after Less Relevant Pages removed: {stage_counts['Ranking Relevance']['passed']}")
 
-####
-#Generate job match numbers for how well each job matches the resume
-####
-print("\nGenerating Job Match Number...")
-random.shuffle(links)
-
-if debug:
-    if len(links) > 0:
-        now = datetime.now()
-        before_timestamp = now.timestamp()
+# Record how each stage went for the metrics
+for name, counts in stage_counts.items():
+    for result in ('received', 'passed', 'failed'):
+        metrics.count('scroop_stage_items', counts[result], stage=name, result=result)
+    metrics.set('scroop_stage_busy_seconds', counts['busy_seconds'], stage=name)
+    metrics.set('scroop_stage_seconds', counts['seconds'], stage=name)
+    metrics.set('scroop_stage_workers', counts['workers'], stage=name)
 
-with ThreadPoolExecutor(max_workers=threads) as executor:
-    results = list(tqdm(executor.map(generate_gpt_job_match, links, [bullet_resume]*len(links), [open_ai_key]*len(links)), total=len(links)))
-if debug:
-    if len(links) > 0:
-        now = datetime.now()
-        after_timestamp = now.timestamp()
 
-        site_search_log = f"generate_gpt_job_match {threads} - {(after_timestamp - before_timestamp)/len(links)} seconds per thread"
+# All the pages are fetched at this point, close the browsers before building the report
+browser_pool.shutdown()
 
-        with open('threads.log', 'a') as f:
-            f.write(site_search_log + '\n\n\n')
+print(f"OpenAI: {llm_stats['requests']} requests, {llm_stats['retries']} retries ({llm_stats['rate_limited']} rate limited), {round(llm_stats['throttle_seconds'])} seconds throttled, {llm_stats['prompt_tokens'] + llm_stats['completion_tokens']} tokens, {llm_stats['cache_hits']} cached replies reused ({llm_stats['cache_misses']} misses), {llm_stats['tokens_trimmed']} tokens trimmed from summary inputs")
 
- 
 
 ####
 #Generate the output file
@@ -213,18 +232,15 @@ output_summary = []
 
 # Iterate over each link in the list of links
 for i, link in enumerate(links, start=1):
-    # Generate a filename based on the MD5 hash of the link
-    filename = f"{hashlib.md5(link.encode()).hexdigest()}_rating.txt"
-    # Construct the full file path
-    filepath = os.path.join('cached_pages', filename)
-
     try:
-        # Attempt to open the file and read the job match rating
-        with open(filepath, 'r') as file:
-            job_match = file.read()
+        # Attempt to read the job match rating from the cache
+        job_match = get_cached(link, 'rating')
 
         job_match = int(job_match.strip())
 
+        # The same job found on other sites
+        also_posted = get_cluster_links(link)
+
         # Print the current link and its job match rating
         progress_list = f"{i}/{len(links)}: {link} - {job_match}"
         if job_match >= 8:
@@ -233,11 +249,10 @@ for i, link in enumerate(links, start=1):
             summary_string_temp = ""
             # Write the job match, job URL, and job description to the file
             summary_string_temp += f"{job_match} -- {link}\n"
-            # Read the summary from the summary file
-            filename = f"{hashlib.md5(link.encode()).hexdigest()}_summary.txt"
-            filepath = os.path.join('cached_pages', filename)
-            with open(filepath, 'r') as summary_file:
-                summary = summary_file.read()
+            for duplicate in also_posted:
+                summary_string_temp += f"Also Posted At: {duplicate}\n"
+            # Read the summary from the cache
+            summary = get_cached(link, 'summary')
 
             summary_string_temp +=f"Job Description:\n{summary}\n\n\n\n"
 
@@ -250,11 +265,12 @@ for i, link in enumerate(links, start=1):
             print(f"      {progress_list}")
 
         # Append the timestamp, link, and job match rating to the output data
-        output_csv.append([datetime.now().strftime("%m-%d-%Y_%I-%M-%p"), job_match, link])
+        output_csv.append([datetime.now().strftime("%m-%d-%Y_%I-%M-%p"), job_match, link, ' '.join(also_posted)])
 
-        # Append the link to the scanned sites log file
-        with open('scanned_sites.log', 'a') as file:
-            file.write(f"{link}\n")
+        # Record the link as rated, so it's skipped in future runs, and the copies of it on other sites along with it
+        mark_seen(link, 'rated')
+        for duplicate in also_posted:
+            mark_seen(duplicate, 'duplicate')
     except Exception as e:
         # In case something went wrong we're going to drop the link from the sites 
         # log as well as remove the content from the cache, in the hopes that it goes 
@@ -263,36 +279,16 @@ for i, link in enumerate(links, start=1):
         # If an error occurs, print the link in red
         cprint(f"Error: {e}\n\t{link}", 'red')
         
-        # Remove the link from the scanned sites log file, so we'll try again next time
-        with open('scanned_sites.log', 'r') as file:
-            lines = [line for line in file if line.strip("\n") != link]
-        with open('scanned_sites.log', 'w') as file:
-            file.writelines(lines)
-        print("\tRemoved from scanned sites log")
-        
-        # Generate a filename based on the MD5 hash of the link
-        filename_hash = hashlib.md5(link.encode()).hexdigest()
-        # Get a list of all files in the directory
-        files = os.listdir('cached_pages')
-
-        # Iterate over the files
-        for file in files:
-            # If the filename_hash is in the file name
-            if filename_hash in file:
-                # Check if the 'cached_pages/removed' directory exists, create it if it doesn't
-                removed_dir = 'cached_pages/removed'
-                if not os.path.exists(removed_dir):
-                    os.makedirs(removed_dir)
-                # Construct the full file path
-                file_path = os.path.join('cached_pages', file)
+        # Mark the link as failed, so we'll try again next time
+        mark_seen(link, 'failed')
+        print("\tMarked as failed in the seen links")
 
-                # Construct the destination path
-                dest_path = os.path.join(removed_dir, file)
-
-                # Move the file
-                shutil.move(file_path, dest_path)
-
-                print(f"\tMoved cached file to - {dest_path}")
+        # Let the copies of the job on other sites be tried next time too
+        forget_cluster(link)
+        
+        # Move the cached page, summary, and rating out of the cache, a copy is kept in the removed_pages table
+        if remove_cached(link):
+            print(f"\tMoved cached data to removed_pages")
 
 
 # Sort the output data by the job match rating highest to lowest
@@ -303,11 +299,11 @@ if len(output_csv)>0: # Only write the output data to a CSV file if there is dat
     # Write the output data to the CSV file
     with open(output_csv_filename, 'w', newline='') as file:
         writer = csv.writer(file)
-        writer.writerow(['Timestamp','Job Match Rating', 'Link'])  # Write the header
+        writer.writerow(['Timestamp','Job Match Rating', 'Link', 'Also Posted At'])  # Write the header
         writer.writerows(output_csv)  # Write the data
 
         # Assuming output_csv is a list of lists
-    df = pd.DataFrame(output_csv, columns=['Timestamp','Job Match Rating', 'Link'])
+    df = pd.DataFrame(output_csv, columns=['Timestamp','Job Match Rating', 'Link', 'Also Posted At'])
     # Convert the DataFrame to an HTML table
     csv_table = df.to_html(index=False)
 
@@ -326,6 +322,15 @@ if len(output_summary)>0: # Only write the output data to a file if there is dat
 else:
     summary_blank=True
 
+# The report is written, the run doesn't need resuming
+finish_run(run_id)
+
+# Write out the metrics for the run, for Prometheus and as JSON
+metrics.set('scroop_run_seconds', round(time.time() - metrics.started, 2))
+metrics.set('scroop_run_timestamp_seconds', round(time.time()))
+metrics.write(metrics_file, metrics_json_file)
+tracer.write(trace_file)
+
 
 # Get today's date
 today = datetime.today()
@@ -0,0 +1,135 @@
+
+# Standard library imports
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+
+# Handed out when tracing is off, so a span costs one check and nothing else
+no_span = nullcontext()
+
+
+class Span:
+    # One timed piece of work on the current thread, recorded when the block exits
+
+    __slots__ = ('tracer', 'name', 'category', 'args', 'started')
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.category, self.started, time.perf_counter_ns() - self.started, self.args)
+        return False
+
+
+class Tracer:
+    # Records spans for a trace that opens in Perfetto (ui.perfetto.dev) or chrome://tracing. Every thread gets its
+    # own track with its spans nested the way they ran, and every link gets a track of its own showing the stages it
+    # went through, built from the stage spans when the trace is written. Off until enable is called, and when it's
+    # on a span is a timestamp and a list append, so it can be left on
+
+    def __init__(self, max_events=1000000):
+        self.enabled = False
+        self.max_events = max_events
+        self.events = []
+        self.dropped = 0
+
+        # Each thread gets a track number the first time it records a span. Thread idents are reused once a thread
+        # ends, so they can't be the track
+        self.thread_names = {}
+        self.thread_local = threading.local()
+        self.track_lock = threading.Lock()
+        self.started = time.perf_counter_ns()
+
+    def enable(self, max_events=None):
+        if max_events is not None:
+            self.max_events = max_events
+        self.started = time.perf_counter_ns()
+        self.enabled = True
+
+    def span(self, name, category='scroop', **args):
+        if not self.enabled:
+            return no_span
+        return Span(self, name, category, args)
+
+    def record(self, name, category, started, duration, args):
+        # list.append is atomic, so the threads don't need a lock. Past max_events spans are counted but not kept,
+        # so a long run can't use up the memory
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+
+        thread_id = getattr(self.thread_local, 'track', None)
+        if thread_id is None:
+            with self.track_lock:
+                thread_id = self.thread_local.track = len(self.thread_names) + 1
+                self.thread_names[thread_id] = threading.current_thread().name
+        self.events.append((name, category, thread_id, started, duration, args))
+
+    def trace_events(self):
+        pid = os.getpid()
+
+        def microseconds(nanoseconds):
+            return (nanoseconds - self.started) / 1000
+
+        # Name each thread's track
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id, 'args': {'name': thread_name}}
+            for thread_id, thread_name in self.thread_names.items()
+        ]
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'scroop'}})
+
+        # The spans on their threads' tracks
+        link_stages = {}
+        for name, category, thread_id, started, duration, args in list(self.events):
+            events.append({
+                'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': thread_id,
+                'ts': microseconds(started), 'dur': duration / 1000, 'args': args,
+            })
+
+            # Stage spans are for a link, or a list of links for the batch stages
+            if category == 'stage':
+                for link in args.get('links') or [args.get('link')]:
+                    if link:
+                        link_stages.setdefault(link, []).append((name, started, duration))
+
+        # Each link's track is an async slice named for the link, from its first stage starting to its last stage
+        # finishing, with the stages nested inside
+        for number, (link, stages) in enumerate(link_stages.items(), start=1):
+            first = min(started for _, started, _ in stages)
+            last = max(started + duration for _, started, duration in stages)
+            events.append({'name': link, 'cat': 'link', 'ph': 'b', 'id': number, 'pid': pid, 'ts': microseconds(first)})
+            for name, started, duration in sorted(stages, key=lambda stage: stage[1]):
+                events.append({'name': name, 'cat': 'link', 'ph': 'b', 'id': number, 'pid': pid, 'ts': microseconds(started)})
+                events.append({'name': name, 'cat': 'link', 'ph': 'e', 'id': number, 'pid': pid, 'ts': microseconds(started + duration)})
+            events.append({'name': link, 'cat': 'link', 'ph': 'e', 'id': number, 'pid': pid, 'ts': microseconds(last)})
+
+        return events
+
+    def write(self, path):
+        if not self.enabled:
+            return
+
+        output = {
+            'traceEvents': self.trace_events(),
+            'displayTimeUnit': 'ms',
+            'otherData': {'dropped_spans': self.dropped},
+        }
+
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump(output, file)
+        os.replace(temporary_path, path)
+
+
+# The tracer for the whole run, every module records into this one
+tracer = Tracer()